@@ -0,0 +1,79 @@
+# animation.py: Sprite animations driven by one shared clock
+#
+# An Animation is a sequence of frames loaded once and shared by every sprite
+# showing it. Instead of advancing each sprite every frame, one clock counts
+# the ticks and each sprite's current frame is computed from the tick when it
+# is drawn. AnimatedGroup draws all its sprites with a single Surface.blits
+# call.
+
+import pygame
+
+class Animation():
+    """The surfaces 'frames', each shown for 'rate' ticks."""
+    def __init__(self, frames, rate=6):
+        self.frames = tuple(frames)
+        self.rate = rate
+        self.length = len(self.frames) * rate
+        self.size = self.frames[0].get_size()
+
+    def frame(self, tick):
+        """Returns the frame shown at 'tick'."""
+        return self.frames[tick % self.length // self.rate]
+
+class AnimationClock():
+    """Counts the ticks of all animations, usually one per frame."""
+    def __init__(self):
+        self.tick = 0
+
+    def advance(self, ticks=1):
+        self.tick += ticks
+
+# The clock of all sprites unless they are given another one
+CLOCK = AnimationClock()
+
+class AnimatedSprite(pygame.sprite.Sprite):
+    """A sprite showing 'animation' at 'position'. Sprites with different
+    'phase' show different frames at the same tick."""
+    def __init__(self, animation, position=(0, 0), clock=CLOCK, phase=0):
+        super().__init__()
+        self.animation = animation
+        self.clock = clock
+        self.phase = phase
+        self.rect = pygame.Rect(position, animation.size)
+
+    @property
+    def image(self):
+        return self.animation.frame(self.clock.tick + self.phase)
+
+    def update_position(self, x, y):
+        self.rect = pygame.Rect((x, y), self.animation.size)
+
+class AnimatedGroup(pygame.sprite.RenderUpdates):
+    """A group of sprites drawn with one Surface.blits call, or one blit per
+    sprite if 'batched' is false. Just like RenderUpdates, 'draw' returns
+    the rectangles that changed."""
+    def __init__(self, *sprites, batched=True):
+        super().__init__(*sprites)
+        self.batched = batched
+
+    def draw(self, surface, bgsurf=None, special_flags=0):
+        if not self.batched:
+            return super().draw(surface, bgsurf, special_flags)
+        sprites = self.sprites()
+        rects = surface.blits([(sprite.image, sprite.rect, None, special_flags)
+                               for sprite in sprites])
+        dirty = self.lostsprites
+        self.lostsprites = []
+        spritedict = self.spritedict
+        for sprite, new_rect in zip(sprites, rects):
+            old_rect = spritedict[sprite]
+            if old_rect:
+                if new_rect.colliderect(old_rect):
+                    dirty.append(new_rect.union(old_rect))
+                else:
+                    dirty.append(new_rect)
+                    dirty.append(old_rect)
+            else:
+                dirty.append(new_rect)
+            spritedict[sprite] = new_rect
+        return dirty
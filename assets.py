@@ -0,0 +1,81 @@
+# assets.py: A process-wide cache for decoded images and composed tile sets
+
+import threading
+import collections
+
+def surface_bytes(surface):
+    """Returns the number of bytes used by the pixels of the PyGame surface
+    'surface'. Subsurfaces share the pixels of their parent and are free."""
+    if surface.get_parent() is not None:
+        return 0
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+def pixels_bytes(surfaces):
+    """Returns the number of bytes used by the pixels of the PyGame surfaces
+    'surfaces', counting the parents of subsurfaces, each only once."""
+    parents = {}
+    for surface in surfaces:
+        parent = surface.get_abs_parent()
+        parents[id(parent)] = parent
+    return sum(surface_bytes(parent) for parent in parents.values())
+
+class AssetCache():
+    """A least recently used cache of assets, e.g. tile sheets or tile
+    directories. Every asset has a size in bytes and the least recently used
+    assets are dropped as soon as all assets take up more than
+    'memory_budget' bytes."""
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.assets = collections.OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, key):
+        return key in self.assets
+
+    def get(self, key, load):
+        """Returns the asset stored under 'key'. If there is none, 'load' is
+        called without arguments and has to return a tuple of the asset and
+        its size in bytes. The asset is then stored under 'key'. Different
+        threads may use the cache at the same time."""
+        with self.lock:
+            if key in self.assets:
+                self.hits += 1
+                self.assets.move_to_end(key)
+                return self.assets[key][0]
+            self.misses += 1
+            asset, size = load()
+            self.assets[key] = (asset, size)
+            self.memory += size
+            self.evict()
+            return asset
+
+    def evict(self):
+        """Drops least recently used assets until the cache fits into the
+        memory budget. The most recently used asset is always kept."""
+        with self.lock:
+            while self.memory > self.memory_budget and len(self.assets) > 1:
+                key, (asset, size) = self.assets.popitem(last=False)
+                self.memory -= size
+                self.evictions += 1
+
+    def clear(self):
+        """Drops all assets. The statistics are kept."""
+        with self.lock:
+            self.assets.clear()
+            self.memory = 0
+
+    def statistics(self):
+        """Returns a dictionary of the cache statistics."""
+        lookups = self.hits + self.misses
+        return {"hits":self.hits,
+                "misses":self.misses,
+                "hit_rate":self.hits / lookups if lookups else 0.0,
+                "evictions":self.evictions,
+                "assets":len(self.assets),
+                "memory":self.memory,
+                "memory_budget":self.memory_budget,
+               }
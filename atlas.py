@@ -0,0 +1,153 @@
+# atlas.py: Baking composed tile sets into atlas files for fast loading
+#
+# An atlas file starts with the magic bytes b"PMDATLAS", followed by the
+# length of the header as four byte big endian integer, the header as JSON
+# and the raw RGB pixels of the atlas image. The atlas image is a grid of all
+# distinct tiles of a tile set. The header contains the grid layout, the
+# colorkey, the tile codes and their positions in the grid and the
+# modification times of the files the atlas was baked from.
+
+import os
+import sys
+import json
+import math
+import struct
+import tempfile
+
+import pygame
+
+import blitter
+
+MAGIC = b"PMDATLAS"
+VERSION = 1
+
+def source_times(sources):
+    """Returns a dictionary of the modification times of the files
+    'sources' in nanoseconds."""
+    return {source:os.stat(source).st_mtime_ns for source in sources}
+
+def save_atlas(filename, tile_directory, sources, legend_hash):
+    """Writes the tiles in 'tile_directory' to the atlas file 'filename'.
+    Equal tiles are only stored once. 'sources' are the files the tiles were
+    made from and 'legend_hash' identifies the legend used."""
+    # Collect distinct tiles
+    size_x, size_y = next(iter(tile_directory.values())).get_size()
+    slots = {}
+    index = {}
+    for code in sorted(tile_directory):
+        pixels = pygame.image.tobytes(tile_directory[code], "RGB")
+        index[code] = slots.setdefault(pixels, len(slots))
+    columns = max(1, math.ceil(math.sqrt(len(slots))))
+    lines = max(1, math.ceil(len(slots) / columns))
+
+    # Arrange them in a grid
+    image = pygame.Surface((columns * size_x, lines * size_y))
+    blitter.blit_all(image, [(pygame.image.frombuffer(pixels, (size_x, size_y), "RGB"),
+                              ((slot % columns) * size_x, (slot // columns) * size_y))
+                             for pixels, slot in slots.items()])
+
+    colorkey = next(iter(tile_directory.values())).get_colorkey()
+    header = {"version":VERSION,
+              "size":[size_x, size_y],
+              "columns":columns,
+              "lines":lines,
+              "colorkey":list(colorkey[:3]) if colorkey else None,
+              "sources":source_times(sources),
+              "legend":legend_hash,
+              "index":index,
+             }
+    header = json.dumps(header, sort_keys=True).encode("utf-8")
+    # Write to a file of its own first, so no reader ever sees a half
+    # written atlas
+    atlas_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename) or ".",
+                                             delete=False)
+    try:
+        with atlas_file:
+            atlas_file.write(MAGIC + struct.pack(">I", len(header)) + header)
+            atlas_file.write(pygame.image.tobytes(image, "RGB"))
+        os.replace(atlas_file.name, filename)
+    except OSError:
+        os.remove(atlas_file.name)
+        raise
+
+def read_atlas(filename, sources, legend_hash):
+    """Reads the atlas file 'filename' without converting the atlas image,
+    so it can be done in any thread. Returns None if the file is missing or
+    was not baked from the current versions of 'sources' and the legend
+    'legend_hash'. Otherwise returns the header and the atlas image. A
+    broken file is treated like a missing one, so it is baked again."""
+    try:
+        with open(filename, "rb") as atlas_file:
+            data = atlas_file.read()
+    except OSError:
+        return None
+    if data[:len(MAGIC)] != MAGIC:
+        return None
+    start = len(MAGIC) + 4
+    try:
+        header_length, = struct.unpack(">I", data[len(MAGIC):start])
+        header = json.loads(data[start:start + header_length].decode("utf-8"))
+        if (header["version"] != VERSION or header["legend"] != legend_hash
+                or header["sources"] != source_times(sources)):
+            return None
+        size_x, size_y = header["size"]
+        columns, lines = header["columns"], header["lines"]
+        slots = range(columns * lines)
+        if (min(size_x, size_y, columns, lines) <= 0 or "colorkey" not in header
+                or not all(slot in slots for slot in header["index"].values())):
+            return None
+    except (OSError, ValueError, TypeError, KeyError, AttributeError, struct.error):
+        return None
+    image_size = (columns * size_x, lines * size_y)
+    body = memoryview(data)[start + header_length:]
+    if len(body) != image_size[0] * image_size[1] * 3:
+        return None
+
+    # Turn the pixels into a PyGame surface with a single copy
+    image = pygame.image.frombuffer(body, image_size, "RGB")
+    return header, image.copy()
+
+def atlas_tiles(header, image):
+    """Returns a tile directory of the atlas image 'image' described by
+    'header' and the size of the image in bytes. Converts the image if the
+    display is set, which has to be done on the main thread."""
+    if pygame.display.get_surface() is not None:
+        image = image.convert()
+    if header["colorkey"] is not None:
+        image.set_colorkey(header["colorkey"])
+
+    size_x, size_y = header["size"]
+    columns = header["columns"]
+    tile_directory = {}
+    for code, slot in header["index"].items():
+        position = ((slot % columns) * size_x, (slot // columns) * size_y)
+        tile_directory[code] = image.subsurface(position + (size_x, size_y))
+    return tile_directory, image.get_width() * image.get_height() * image.get_bytesize()
+
+def load_atlas(filename, sources, legend_hash):
+    """Loads the tiles from the atlas file 'filename'. Returns None if the
+    file is missing or was not baked from the current versions of 'sources'
+    and the legend 'legend_hash'. Otherwise returns a tile directory and the
+    size of the atlas image in bytes."""
+    atlas = read_atlas(filename, sources, legend_hash)
+    if atlas is None:
+        return None
+    return atlas_tiles(*atlas)
+
+def main(arguments):
+    """Bakes the atlases of the tile sets named in 'arguments' or of all
+    tile sets if none are named."""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import main02
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    names = arguments or sorted(name[:-4] for name in os.listdir(main02.FOLDERS["MAPS"])
+                                if name.endswith(".png"))
+    for name in names:
+        legend = main02.load_legend(name)
+        main02.bake_tile_set(name, legend)
+        print("Baked {0}.".format(main02.atlas_file_name(name)))
+    pygame.quit()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
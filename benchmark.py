@@ -0,0 +1,438 @@
+# benchmark.py: Headless benchmarks of loading, rendering and the game loop
+#
+# Runs PyGame with the SDL dummy video driver and times every stage
+# separately. The results are written as JSON. Use --compare to check them
+# against a saved baseline, e.g.
+#
+#     python benchmark.py --output baseline.json
+#     python benchmark.py --compare baseline.json
+#
+# To compare batched blits to one blit per tile or sprite, run
+#
+#     python benchmark.py --blit-mode single --output single.json
+#     python benchmark.py --blit-mode batched --compare single.json
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import contextlib
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+import main02
+import animation
+import blitter
+import simulation
+import dungeon
+import font
+import fov
+import loader
+import pathfinding
+
+SYNTHETIC_SIZES = [10, 100, 500, 1000]
+# Synthetic maps larger than this are only rendered in chunks, a single
+# surface for the whole map would take gigabytes.
+FULL_RENDER_LIMIT = 200
+FRAME_KEYS = "dddssaaaww"
+FLOOR_SIZES = [(56, 32), (112, 64), (224, 128), (500, 500)]
+MONSTER_COUNTS = [1, 10, 100, 1000]
+SPRITE_COUNTS = [10, 100, 500]
+PATHFINDING_SIZE = (112, 64)
+MESSAGE_COUNTS = [1, 10, 100]
+
+def percentile(values, p):
+    """Returns the 'p'-th percentile of 'values' using the nearest rank."""
+    values = sorted(values)
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+def summarize(times):
+    """Returns statistics of the times 'times' given in seconds. The
+    statistics are in milliseconds."""
+    milliseconds = [t * 1000 for t in times]
+    return {"n":len(milliseconds),
+            "min":min(milliseconds),
+            "mean":sum(milliseconds) / len(milliseconds),
+            "p50":percentile(milliseconds, 50),
+            "p90":percentile(milliseconds, 90),
+            "p99":percentile(milliseconds, 99),
+            "max":max(milliseconds),
+           }
+
+def measure(function, repeat, setup=None):
+    """Calls 'function' 'repeat' times and returns the time each call took.
+    If given, 'setup' is called untimed before each call."""
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def synthetic_map(size, seed=0):
+    """Returns a random square map of walls, floor and water with 'size'
+    tiles on each side."""
+    generator = random.Random(seed)
+    return ["".join(generator.choice("XX...o") for x in range(size)) for y in range(size)]
+
+def synthetic_level(size, tile_set="nd"):
+    """Returns a level with a synthetic map of size 'size'."""
+    level = main02.Level()
+    level.load_data(synthetic_map(size), "X", [1, 1], [size - 2, size - 2], tile_set)
+    return level
+
+def tile_set_names():
+    return sorted(name[:-4] for name in os.listdir(main02.FOLDERS["MAPS"]) if name.endswith(".png"))
+
+def level_files():
+    return sorted(main02.FOLDERS["LEVELS"] + "/" + name
+                  for name in os.listdir(main02.FOLDERS["LEVELS"]) if name.endswith(".ini"))
+
+def benchmark_tile_sets(results, repeat):
+    for name in tile_set_names():
+        legend = main02.load_legend(name)
+        results["load_tile_set/" + name] = summarize(measure(
+            lambda: main02.load_tile_set(name, legend), repeat, main02.ASSET_CACHE.clear))
+        results["compose_tile_set/" + name] = summarize(measure(
+            lambda: main02.compose_tile_set(name, legend), repeat, main02.ASSET_CACHE.clear))
+
+def benchmark_levels(results, repeat):
+    for filename in level_files():
+        name = os.path.basename(filename)
+        level = main02.Level()
+        results["load_file/" + name] = summarize(measure(lambda: level.load_file(filename), repeat))
+        results["render/" + name] = summarize(measure(level.render, repeat))
+
+def benchmark_synthetic(results, repeat, sizes, tile_set):
+    screen = pygame.display.get_surface()
+    for size in sizes:
+        name = "{0}x{0}".format(size)
+        level = synthetic_level(size, tile_set)
+        results["get_tile_codes/" + name] = summarize(measure(level.get_tile_codes, repeat))
+        if size <= FULL_RENDER_LIMIT:
+            results["render/" + name] = summarize(measure(level.render, repeat))
+        position = (-size * level.tile_size[0] // 2, -size * level.tile_size[1] // 2)
+        results["render_chunked/" + name] = summarize(measure(
+            lambda: level.render_chunked().draw(screen, position), repeat))
+
+def benchmark_memory(results, sizes, tile_set):
+    """Measures the memory allocated for the tiles of synthetic levels."""
+    for size in sizes:
+        level_map = synthetic_map(size)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        level = main02.Level()
+        level.load_data(level_map, "X", [1, 1], [size - 2, size - 2], tile_set)
+        allocated = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        tiles = level.grid.stride * level.grid.lines
+        results["memory/{0}x{0}".format(size)] = {
+            "tiles":tiles,
+            "grid_bytes":level.grid.nbytes(),
+            "allocated_bytes":allocated,
+            "bytes_per_million_tiles":allocated * 10**6 / tiles,
+        }
+
+def benchmark_floors(results, repeat, tile_set):
+    """Measures how many floors per second can be generated and how many can
+    be generated and classified."""
+    for size in FLOOR_SIZES:
+        name = "{0}x{1}".format(*size)
+        seeds = iter(range(10**9))
+        generate = lambda: dungeon.generate_floor(size[0], size[1], next(seeds))
+        statistics = summarize(measure(generate, repeat))
+        statistics["floors_per_second"] = 1000 / statistics["mean"]
+        results["generate_floor/" + name] = statistics
+
+        def classify():
+            floor = generate()
+            level = main02.Level()
+            level.load_data(floor.map, floor.default_tile, floor.player_position,
+                            floor.stairs_position, tile_set)
+            level.get_tile_codes()
+        statistics = summarize(measure(classify, repeat))
+        statistics["floors_per_second"] = 1000 / statistics["mean"]
+        results["generate_and_classify_floor/" + name] = statistics
+
+def benchmark_pathfinding(results, repeat, tile_set):
+    """Measures turns of monsters chasing the player, who walks one tile per
+    turn. All monsters share the distance field of the player."""
+    floor = dungeon.generate_floor(PATHFINDING_SIZE[0], PATHFINDING_SIZE[1], 0)
+    level = main02.Level()
+    level.load_data(floor.map, floor.default_tile, floor.player_position,
+                    floor.stairs_position, tile_set)
+    finder = pathfinding.PathFinder(level)
+    floor_tiles = [(x, y) for y in range(level.height) for x in range(level.width)
+                   if finder.is_walkable(x, y)]
+    for count in MONSTER_COUNTS:
+        generator = random.Random(count)
+        monsters = generator.sample(floor_tiles, min(count, len(floor_tiles)))
+        player = tuple(floor.player_position)
+        def turn():
+            nonlocal player
+            x, y = player
+            player = generator.choice([(x + dx, y + dy) for dx, dy in pathfinding.STEPS
+                                       if finder.is_walkable(x + dx, y + dy)] or [player])
+            occupied = set(monsters)
+            for i, monster in enumerate(monsters):
+                step = finder.next_step(monster, player, occupied)
+                if step is not None and step != player:
+                    occupied.discard(monster)
+                    occupied.add(step)
+                    monsters[i] = step
+        results["monster_turn/{0}".format(count)] = summarize(measure(turn, repeat * 4))
+
+    # Repairing the fields after a wall is broken or built
+    walls = [(x, y) for y in range(1, level.height - 1) for x in range(1, level.width - 1)
+             if not finder.is_walkable(x, y)]
+    finder.field(tuple(floor.player_position))
+    finder.field(tuple(floor.stairs_position))
+    generator = random.Random(0)
+    def toggle():
+        tile = generator.choice(walls)
+        finder.set_walkable(tile[0], tile[1], True)
+        finder.set_walkable(tile[0], tile[1], False)
+    results["pathfinding_toggle_tile"] = summarize(measure(toggle, repeat * 4))
+
+def benchmark_fov(results, repeat, tile_set):
+    """Measures computing fields of view from random floor tiles, with and
+    without the cache, and updating the fog of war."""
+    floor = dungeon.generate_floor(PATHFINDING_SIZE[0], PATHFINDING_SIZE[1], 0)
+    level = main02.Level()
+    level.load_data(floor.map, floor.default_tile, floor.player_position,
+                    floor.stairs_position, tile_set)
+    floor_tiles = [(x, y) for y in range(level.height) for x in range(level.width)
+                   if level.grid.get_flags(x, y) & main02.grid.WALKABLE]
+    field_of_view = fov.FieldOfView(level, simulation.FOV_RADIUS, 0)
+    generator = random.Random(0)
+    compute = lambda: field_of_view.compute(*generator.choice(floor_tiles))
+    results["fov_compute"] = summarize(measure(compute, repeat * 20))
+    field_of_view = fov.FieldOfView(level, simulation.FOV_RADIUS)
+    tiles = floor_tiles[:200]
+    for tile in tiles:
+        field_of_view.compute(*tile)
+    compute = lambda: field_of_view.compute(*generator.choice(tiles))
+    results["fov_compute_cached"] = summarize(measure(compute, repeat * 20))
+    fog = fov.FogOfWar(field_of_view)
+    update = lambda: fog.update(*generator.choice(tiles))
+    results["fog_update"] = summarize(measure(update, repeat * 20))
+
+def benchmark_sprites(results, repeat):
+    """Measures drawing frames of animated sprites sharing the player's
+    animation, scattered over the screen."""
+    screen = pygame.display.get_surface()
+    background = screen.copy()
+    player = main02.Player(synthetic_level(10))
+    with contextlib.redirect_stdout(io.StringIO()):
+        player.load_file("players/test01.ini")
+    idle = player.render().animation
+    for count in SPRITE_COUNTS:
+        generator = random.Random(count)
+        group = animation.AnimatedGroup(batched=main02.BLIT_MODE == "batched")
+        for i in range(count):
+            position = (generator.randrange(main02.SCREEN_SIZE[0] - 24),
+                        generator.randrange(main02.SCREEN_SIZE[1] - 24))
+            group.add(animation.AnimatedSprite(idle, position, phase=generator.randrange(24)))
+        def frame():
+            group.clear(screen, background)
+            animation.CLOCK.advance()
+            group.draw(screen)
+        statistics = summarize(measure(frame, repeat * 20))
+        statistics["frames_per_second"] = 1000 / statistics["mean"]
+        results["sprites/{0}".format(count)] = statistics
+
+def benchmark_minimap(results, repeat, sizes, tile_set):
+    """Measures making the minimap and the zoomed out backgrounds of
+    synthetic levels, compared to shrinking the whole rendered level, and
+    drawing the minimap."""
+    screen = pygame.display.get_surface()
+    for size in sizes:
+        name = "{0}x{0}".format(size)
+        level = synthetic_level(size, tile_set)
+        level.render_pyramid(main02.MINIMAP_SCALES)
+        results["pyramid/" + name] = summarize(measure(
+            lambda: main02.LevelPyramid(level, main02.MINIMAP_SCALES), repeat))
+        if size <= FULL_RENDER_LIMIT:
+            def shrink():
+                image = level.render()
+                for scale in main02.MINIMAP_SCALES:
+                    pygame.transform.smoothscale(image, (image.get_width() // scale,
+                                                         image.get_height() // scale))
+            results["shrink_render/" + name] = summarize(measure(shrink, repeat))
+        fog = fov.FogOfWar(fov.FieldOfView(level, simulation.FOV_RADIUS))
+        minimap = main02.MinimapLayer(level, fog)
+        minimap.move_marker(size // 2, size // 2)
+        results["minimap_draw/" + name] = summarize(measure(
+            lambda: minimap.draw(screen, (0, 0)), repeat * 20))
+        results["minimap_set_tile/" + name] = summarize(measure(
+            lambda: level.set_tile(size // 2, size // 2, "X"), repeat,
+            lambda: level.set_tile(size // 2, size // 2, ".")))
+
+def benchmark_text(results, repeat):
+    """Measures rendering lines of text with and without the line cache and
+    drawing the message log after many messages in one turn."""
+    screen = pygame.display.get_surface()
+    text_font = font.BitmapFont(main02.FONT_LEGEND, main02.FONT_CACHE_SIZE)
+    line = "A monster caught you on floor 10!"
+    results["text_render"] = summarize(measure(lambda: text_font.render(line), repeat * 20,
+                                               text_font.lines.clear))
+    results["text_render_cached"] = summarize(measure(lambda: text_font.render(line), repeat * 20))
+    log = font.MessageLog(text_font, main02.SCREEN_SIZE[0] - 4, main02.LOG_LINES)
+    for count in MESSAGE_COUNTS:
+        def turn():
+            for i in range(count):
+                log.add("Message {0} of this turn".format(i % 10))
+            log.draw(screen, (2, 2))
+        results["message_log/{0}".format(count)] = summarize(measure(turn, repeat * 20))
+
+def benchmark_startup(results, repeat, level_file, tile_set):
+    """Measures the time to the first frame of a game on 'level_file' with
+    empty asset cache, loading the assets one after the other while making
+    the game and in advance in the threads of a loader.AssetLoader."""
+    def start(preload):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if preload:
+                asset_loader = loader.AssetLoader(main02.LOADER_WORKERS)
+                main02.preload(asset_loader, main02.PLAYER_FILE, tile_set)
+                asset_loader.wait()
+                asset_loader.shutdown()
+            game = main02.Game(level_file, tile_set=tile_set, floors=0)
+            game.frame([])
+        game.executor.shutdown()
+    name = os.path.basename(level_file)
+    results["startup/" + name] = summarize(measure(lambda: start(False), repeat,
+                                                   main02.ASSET_CACHE.clear))
+    results["startup_preloaded/" + name] = summarize(measure(lambda: start(True), repeat,
+                                                             main02.ASSET_CACHE.clear))
+
+def benchmark_frames(results, frames, level_file):
+    """Runs the game loop for 'frames' frames, pressing the keys in
+    FRAME_KEYS one after the other with some idle frames in between."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        game = main02.Game(level_file, floors=0)
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for frame in range(frames):
+            events = []
+            if frame % 4 == 0:
+                key = FRAME_KEYS[(frame // 4) % len(FRAME_KEYS)]
+                events.append(pygame.event.Event(pygame.KEYDOWN, key=pygame.key.key_code(key)))
+            start = time.perf_counter()
+            game.frame(events)
+            times.append(time.perf_counter() - start)
+    results["frame/" + os.path.basename(level_file)] = summarize(times)
+
+def compare(results, baseline, threshold):
+    """Compares 'results' to 'baseline' and returns a list of regressions,
+    i.e. benchmarks whose median got slower by more than 'threshold'
+    (relative)."""
+    regressions = []
+    for name, statistics in sorted(results.items()):
+        if name not in baseline or "p50" not in statistics:
+            continue
+        before = baseline[name]["p50"]
+        after = statistics["p50"]
+        change = (after - before) / before if before else 0.0
+        mark = ""
+        if change > threshold:
+            mark = "REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            mark = "improvement"
+        print("{0:40} {1:10.3f} ms {2:10.3f} ms {3:+8.1%} {4}".format(
+            name, before, after, change, mark))
+    return regressions
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Headless benchmarks of loading, "
+                                     "rendering and the game loop.")
+    parser.add_argument("--repeat", type=int, default=5, help="repetitions per benchmark")
+    parser.add_argument("--frames", type=int, default=200, help="frames of the game loop")
+    parser.add_argument("--sizes", type=int, nargs="*", default=SYNTHETIC_SIZES,
+                        help="side lengths of the synthetic maps")
+    parser.add_argument("--tile-set", default="nd", help="tile set for levels asking for one")
+    parser.add_argument("--stages", nargs="*",
+                        default=["tile_sets", "levels", "synthetic", "memory", "floors",
+                                 "pathfinding", "fov", "sprites", "minimap", "text", "startup",
+                                 "frames"],
+                        help="stages to run")
+    parser.add_argument("--blit-mode", choices=blitter.MODES, default=main02.BLIT_MODE,
+                        help="blit tiles and sprites in batches or one at a time")
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--compare", help="baseline results to compare to")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slow down counted as regression")
+    options = parser.parse_args(arguments)
+
+    main02.BLIT_MODE = options.blit_mode
+    main02.ask_for_file = lambda directory, extension, question, name_only=False: options.tile_set
+    pygame.init()
+    pygame.display.set_mode(main02.SCREEN_SIZE)
+    random.seed(0)
+
+    results = {}
+    if "tile_sets" in options.stages:
+        benchmark_tile_sets(results, options.repeat)
+    if "levels" in options.stages:
+        benchmark_levels(results, options.repeat)
+    if "synthetic" in options.stages:
+        benchmark_synthetic(results, options.repeat, options.sizes, options.tile_set)
+    if "memory" in options.stages:
+        benchmark_memory(results, options.sizes, options.tile_set)
+    if "floors" in options.stages:
+        benchmark_floors(results, options.repeat, options.tile_set)
+    if "pathfinding" in options.stages:
+        benchmark_pathfinding(results, options.repeat, options.tile_set)
+    if "fov" in options.stages:
+        benchmark_fov(results, options.repeat, options.tile_set)
+    if "sprites" in options.stages:
+        benchmark_sprites(results, options.repeat)
+    if "minimap" in options.stages:
+        benchmark_minimap(results, options.repeat, options.sizes, options.tile_set)
+    if "text" in options.stages:
+        benchmark_text(results, options.repeat)
+    if "startup" in options.stages:
+        benchmark_startup(results, options.repeat, level_files()[0], options.tile_set)
+    if "frames" in options.stages:
+        for level_file in level_files():
+            benchmark_frames(results, options.frames, level_file)
+    pygame.quit()
+
+    report = {"meta":{"python":platform.python_version(),
+                      "pygame":pygame.version.ver,
+                      "numpy":main02.numpy is not None,
+                      "blit_mode":options.blit_mode,
+                      "platform":platform.platform(),
+                      "time":time.strftime("%Y-%m-%d %H:%M:%S"),
+                     },
+              "results":results,
+             }
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            print("{0} regressions found.".format(len(regressions)))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
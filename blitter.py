@@ -0,0 +1,33 @@
+# blitter.py: Submitting many blits at once
+#
+# Each Surface.blit called from Python costs a function call, argument
+# parsing and a Rect for the result, which for a map of small tiles takes
+# longer than copying the pixels. Surface.fblits (pygame-ce) and
+# Surface.blits with doreturn=False take a whole sequence of blits in one
+# call instead. The old way of one call per blit is kept for comparison
+# ("python benchmark.py --blit-mode single").
+
+MODES = ("batched", "single")
+
+def blit_all(surface, blits, batched=True):
+    """Blits the (source, destination) pairs 'blits' onto 'surface'. If
+    'batched' is false, they are blitted one at a time."""
+    if not batched:
+        for source, destination in blits:
+            surface.blit(source, destination)
+    elif hasattr(surface, "fblits"):
+        surface.fblits(blits)
+    else:
+        surface.blits(blits, doreturn=False)
+
+def tile_blits(tile_directory, codes, tile_size, offset=(0, 0)):
+    """Returns the list of (tile, position) pairs drawing the rows of tile
+    codes 'codes' with the tiles of 'tile_directory', the first one at
+    'offset'."""
+    tile_x, tile_y = tile_size
+    x0, y0 = offset
+    if hasattr(codes, "tolist"):
+        # Iterating over NumPy arrays is a lot slower than over lists
+        codes = codes.tolist()
+    return [(tile_directory[code], (x0 + u * tile_x, y0 + v * tile_y))
+            for v, row in enumerate(codes) for u, code in enumerate(row)]
@@ -0,0 +1,159 @@
+# config_cache.py: Compiled INI files (levels, legends, players, constants)
+#
+# INI files are parsed with configparser only once. The result is stored as
+# plain dictionaries {section: {option: value}} in a binary cache file that
+# is loaded with marshal. A cached file is reused as long as its modification
+# time and size are unchanged, or, if they changed, as long as the SHA1 hash
+# of its contents is unchanged. Reading only marks the cache as changed; it
+# is written once, when the program calls save_config after starting up and
+# again at exit if more files were compiled since.
+
+import os
+import sys
+import atexit
+import marshal
+import hashlib
+import tempfile
+import threading
+
+MAGIC = b"PMDCONFIG"
+VERSION = 1
+CACHE_FILE = "cache/config.bin"
+FOLDERS = ["constants", "levels", "players", "tile_sets"]
+EXTENSIONS = (".ini", ".leg")
+
+def compile_config(data):
+    """Parses the contents 'data' of an INI file and returns its sections
+    as dictionary {section: {option: value}}."""
+    import configparser
+    parser = configparser.ConfigParser()
+    parser.read_string(data.decode("utf-8"))
+    return {section:dict(parser.items(section)) for section in parser.sections()}
+
+class ConfigCache():
+    """A cache of compiled INI files backed by the file 'filename'."""
+    def __init__(self, filename=CACHE_FILE):
+        self.filename = filename
+        self.entries = None
+        self.changed = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Loads the cache file. A missing or incompatible cache file is
+        treated as empty cache."""
+        self.entries = {}
+        try:
+            with open(self.filename, "rb") as cache_file:
+                data = cache_file.read()
+        except OSError:
+            return
+        header = MAGIC + bytes([VERSION]) + "{0}.{1}".format(*sys.version_info).encode("ascii")
+        if data.startswith(header + b"\n"):
+            try:
+                self.entries = marshal.loads(data[len(header) + 1:])
+            except (EOFError, ValueError, TypeError):
+                self.entries = {}
+
+    def save(self):
+        """Writes the cache file if anything changed."""
+        with self.lock:
+            if not self.changed:
+                return
+            header = MAGIC + bytes([VERSION]) + "{0}.{1}".format(*sys.version_info).encode("ascii")
+            directory = os.path.dirname(self.filename)
+            try:
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                # Other processes may save at the same time, so each writes a
+                # temporary file of its own
+                handle, temporary = tempfile.mkstemp(dir=directory or ".")
+                try:
+                    with os.fdopen(handle, "wb") as cache_file:
+                        cache_file.write(header + b"\n" + marshal.dumps(self.entries))
+                    os.replace(temporary, self.filename)
+                except OSError:
+                    os.remove(temporary)
+                    raise
+            except OSError as error:
+                print("Could not save config cache: {0}".format(error))
+            self.changed = False
+
+    def get(self, filename):
+        """Returns the compiled contents of the INI file 'filename' or None
+        if it does not exist."""
+        if self.entries is None:
+            self.load()
+        key = os.path.normpath(filename)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        entry = self.entries.get(key)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            return entry[3]
+
+        # Only recompile if the contents changed
+        with open(filename, "rb") as config_file:
+            data = config_file.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if entry is None or entry[2] != digest:
+            sections = compile_config(data)
+        else:
+            sections = entry[3]
+        self.entries[key] = (stat.st_mtime_ns, stat.st_size, digest, sections)
+        self.changed = True
+        return sections
+
+    def read(self, filenames):
+        """Returns the merged contents of the INI files 'filenames'. Just
+        like ConfigParser.read, missing files are skipped and options of
+        later files override those of earlier ones."""
+        if isinstance(filenames, str):
+            filenames = [filenames]
+        config = {}
+        with self.lock:
+            for filename in filenames:
+                sections = self.get(filename)
+                if sections is None:
+                    continue
+                for section, options in sections.items():
+                    config.setdefault(section, {}).update(options)
+        return config
+
+    def compile_all(self, folders=FOLDERS):
+        """Compiles all INI files in 'folders' and their subfolders and
+        returns their number."""
+        count = 0
+        for folder in folders:
+            for path, directories, files in os.walk(folder):
+                directories.sort()
+                for name in sorted(files):
+                    if name.endswith(EXTENSIONS):
+                        self.get(os.path.join(path, name))
+                        count += 1
+        self.save()
+        return count
+
+CONFIG_CACHE = ConfigCache()
+
+def read_config(filenames):
+    """Returns the merged contents of the INI files 'filenames' using the
+    process-wide config cache."""
+    return CONFIG_CACHE.read(filenames)
+
+def parse_bool(value):
+    """Returns whether the option value 'value' means yes, like
+    ConfigParser.getboolean does for "1", "yes", "true" and "on"."""
+    return value.lower() in ("1", "yes", "true", "on")
+
+def save_config():
+    """Writes the process-wide config cache if files were compiled since it
+    was last saved."""
+    CONFIG_CACHE.save()
+
+atexit.register(save_config)
+
+if __name__ == "__main__":
+    folders = sys.argv[1:] or FOLDERS
+    print("Compiled {0} files into {1}.".format(CONFIG_CACHE.compile_all(folders),
+                                                CONFIG_CACHE.filename))
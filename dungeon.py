@@ -0,0 +1,156 @@
+# dungeon.py: Generating random dungeon floors
+#
+# A floor is generated like in Pokémon Mystery Dungeon: The map is divided
+# into a grid of cells. Most cells get a room, the others a single junction
+# tile. Neighbouring cells are connected by corridors along a random spanning
+# tree plus some extra connections. Finally, some lakes are put into the
+# walls, so they never block the way, and the player and the stairs are put
+# into two different rooms. The same seed always gives the same floor.
+
+import sys
+import random
+import argparse
+import collections
+
+Floor = collections.namedtuple("Floor", ["map", "default_tile", "player_position",
+                                         "stairs_position", "seed"])
+
+# Size of the cells the map is divided into
+CELL_SIZE = (14, 10)
+ROOM_CHANCE = 0.75
+EXTRA_CORRIDOR_CHANCE = 0.15
+WATER = 0.06
+
+def floor_seed(seed, number):
+    """Returns the seed of the floor 'number' of a dungeon with seed 'seed'."""
+    return "{0}/{1}".format(seed, number)
+
+def carve_corridor(grid, start, end, generator):
+    """Carves an L-shaped corridor of floor tiles from 'start' to 'end'."""
+    (x0, y0), (x1, y1) = start, end
+    if generator.random() < 0.5:
+        corner = (x1, y0)
+    else:
+        corner = (x0, y1)
+    for (ax, ay), (bx, by) in [(start, corner), (corner, end)]:
+        for x in range(min(ax, bx), max(ax, bx) + 1):
+            for y in range(min(ay, by), max(ay, by) + 1):
+                grid[y][x] = "."
+
+def add_lake(grid, size, generator):
+    """Turns up to 'size' wall tiles into water by a random walk. The outer
+    ring of the map and floor tiles are never changed."""
+    height = len(grid)
+    width = len(grid[0])
+    x = generator.randrange(1, width - 1)
+    y = generator.randrange(1, height - 1)
+    for step in range(size):
+        if grid[y][x] == "X":
+            grid[y][x] = "o"
+        dx, dy = generator.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+        x = min(max(x + dx, 1), width - 2)
+        y = min(max(y + dy, 1), height - 2)
+
+def generate_floor(width=56, height=32, seed=None, water=WATER):
+    """Returns a random Floor of 'width' times 'height' tiles generated from
+    'seed'. 'water' is the approximate share of water tiles."""
+    if width < 8 or height < 8:
+        raise ValueError("Floors have to be at least 8x8 tiles large.")
+    generator = random.Random(seed)
+    grid = [["X"] * width for y in range(height)]
+
+    # Divide into cells and put a room or a junction into each cell
+    columns = max(1, (width - 2) // CELL_SIZE[0])
+    lines = max(1, (height - 2) // CELL_SIZE[1])
+    cell_x = (width - 2) // columns
+    cell_y = (height - 2) // lines
+    cells = [(i, j) for j in range(lines) for i in range(columns)]
+    room_cells = [cell for cell in cells if generator.random() < ROOM_CHANCE]
+    while len(room_cells) < min(2, len(cells)):
+        cell = generator.choice(cells)
+        if cell not in room_cells:
+            room_cells.append(cell)
+    rooms = {}
+    centers = {}
+    for i, j in cells:
+        left = 1 + i * cell_x
+        top = 1 + j * cell_y
+        if (i, j) in room_cells:
+            room_x = generator.randint(min(3, cell_x - 2), cell_x - 2)
+            room_y = generator.randint(min(3, cell_y - 2), cell_y - 2)
+            x = left + generator.randint(1, cell_x - room_x - 1)
+            y = top + generator.randint(1, cell_y - room_y - 1)
+            rooms[(i, j)] = (x, y, room_x, room_y)
+            for v in range(y, y + room_y):
+                for u in range(x, x + room_x):
+                    grid[v][u] = "."
+            centers[(i, j)] = (generator.randrange(x, x + room_x),
+                               generator.randrange(y, y + room_y))
+        else:
+            centers[(i, j)] = (generator.randrange(left + 1, left + cell_x - 1),
+                               generator.randrange(top + 1, top + cell_y - 1))
+            grid[centers[(i, j)][1]][centers[(i, j)][0]] = "."
+
+    # Connect the cells along a random spanning tree and some extra edges
+    def neighbours(cell):
+        i, j = cell
+        return [(i + di, j + dj) for di, dj in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                if 0 <= i + di < columns and 0 <= j + dj < lines]
+    visited = {cells[0]}
+    stack = [cells[0]]
+    while stack:
+        cell = stack[-1]
+        options = [other for other in neighbours(cell) if other not in visited]
+        if not options:
+            stack.pop()
+            continue
+        other = generator.choice(options)
+        carve_corridor(grid, centers[cell], centers[other], generator)
+        visited.add(other)
+        stack.append(other)
+    for cell in cells:
+        for other in neighbours(cell):
+            if other > cell and generator.random() < EXTRA_CORRIDOR_CHANCE:
+                carve_corridor(grid, centers[cell], centers[other], generator)
+
+    # Put lakes into the walls
+    lake_tiles = int(water * width * height)
+    while lake_tiles > 0:
+        size = min(lake_tiles, generator.randint(8, 40))
+        add_lake(grid, size, generator)
+        lake_tiles -= size
+
+    # Put player and stairs into different rooms (if there are two)
+    if len(rooms) > 1:
+        player_room, stairs_room = generator.sample(sorted(rooms), 2)
+    else:
+        player_room = stairs_room = next(iter(rooms))
+    positions = []
+    for room in (player_room, stairs_room):
+        x, y, room_x, room_y = rooms[room]
+        while True:
+            position = [generator.randrange(x, x + room_x), generator.randrange(y, y + room_y)]
+            if position not in positions:
+                break
+        positions.append(position)
+
+    return Floor(["".join(row) for row in grid], "X", positions[0], positions[1], seed)
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Prints a random dungeon floor.")
+    parser.add_argument("--width", type=int, default=56)
+    parser.add_argument("--height", type=int, default=32)
+    parser.add_argument("--seed", default=None)
+    options = parser.parse_args(arguments)
+    floor = generate_floor(options.width, options.height, options.seed)
+    for y, row in enumerate(floor.map):
+        row = list(row)
+        if y == floor.player_position[1]:
+            row[floor.player_position[0]] = "P"
+        if y == floor.stairs_position[1]:
+            row[floor.stairs_position[0]] = "S"
+        print("".join(row))
+    print("player: {0}, stairs: {1}".format(floor.player_position, floor.stairs_position))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,111 @@
+# entities.py: A spatial index of the things on a level
+#
+# Entities are the player, the stairs, items, traps and monsters. Each has
+# the attributes 'x' and 'y' and may have the attribute 'blocking' if nothing
+# else can stand on its tile. The index keeps the entities of each tile, so
+# looking up what is on a tile takes constant time, and groups them into
+# square buckets of tiles, so rectangle and radius queries only look at the
+# buckets they overlap instead of at every entity.
+
+class SpatialIndex():
+    """The entities of a level in buckets of 'bucket_size' times
+    'bucket_size' tiles."""
+    def __init__(self, bucket_size=8):
+        self.bucket_size = bucket_size
+        self.positions = {}
+        self.tiles = {}
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, entity):
+        return entity in self.positions
+
+    def __iter__(self):
+        return iter(list(self.positions))
+
+    def bucket(self, x, y):
+        return (x // self.bucket_size, y // self.bucket_size)
+
+    def add(self, entity):
+        """Adds 'entity' at its position ('entity.x', 'entity.y')."""
+        if entity in self.positions:
+            self.remove(entity)
+        position = (entity.x, entity.y)
+        self.positions[entity] = position
+        self.tiles.setdefault(position, []).append(entity)
+        self.buckets.setdefault(self.bucket(*position), set()).add(entity)
+
+    def remove(self, entity):
+        """Removes 'entity' from the index."""
+        position = self.positions.pop(entity)
+        entities = self.tiles[position]
+        entities.remove(entity)
+        if not entities:
+            del self.tiles[position]
+        bucket = self.bucket(*position)
+        self.buckets[bucket].discard(entity)
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+
+    def move(self, entity, x, y):
+        """Moves 'entity' to ('x', 'y') and updates its attributes 'x' and
+        'y'. The bucket sets are only touched if the bucket changes."""
+        old = self.positions[entity]
+        new = (x, y)
+        entity.x, entity.y = new
+        if old == new:
+            return
+        entities = self.tiles[old]
+        entities.remove(entity)
+        if not entities:
+            del self.tiles[old]
+        self.tiles.setdefault(new, []).append(entity)
+        self.positions[entity] = new
+        old_bucket = self.bucket(*old)
+        new_bucket = self.bucket(*new)
+        if old_bucket != new_bucket:
+            self.buckets[old_bucket].discard(entity)
+            if not self.buckets[old_bucket]:
+                del self.buckets[old_bucket]
+            self.buckets.setdefault(new_bucket, set()).add(entity)
+
+    def at(self, x, y):
+        """Returns the entities at ('x', 'y') as tuple."""
+        return tuple(self.tiles.get((x, y), ()))
+
+    def is_blocked(self, x, y):
+        """Returns whether a blocking entity stands at ('x', 'y')."""
+        return any(getattr(entity, "blocking", False) for entity in self.tiles.get((x, y), ()))
+
+    def in_rect(self, x0, y0, x1, y1):
+        """Returns a list of the entities with x0 <= x < x1 and
+        y0 <= y < y1."""
+        found = []
+        bx0, by0 = self.bucket(x0, y0)
+        bx1, by1 = self.bucket(x1 - 1, y1 - 1)
+        if (bx1 - bx0 + 1) * (by1 - by0 + 1) > len(self.buckets):
+            # Fewer buckets in use than overlapped
+            buckets = [bucket for (bx, by), bucket in self.buckets.items()
+                       if bx0 <= bx <= bx1 and by0 <= by <= by1]
+        else:
+            buckets = [self.buckets[(bx, by)] for by in range(by0, by1 + 1)
+                       for bx in range(bx0, bx1 + 1) if (bx, by) in self.buckets]
+        for bucket in buckets:
+            for entity in bucket:
+                x, y = self.positions[entity]
+                if x0 <= x < x1 and y0 <= y < y1:
+                    found.append(entity)
+        return found
+
+    def in_radius(self, x, y, radius):
+        """Returns a list of the entities at most 'radius' tiles (euclidean)
+        away from ('x', 'y')."""
+        found = []
+        reach = int(radius)
+        for entity in self.in_rect(x - reach, y - reach, x + reach + 1, y + reach + 1):
+            u, v = self.positions[entity]
+            if (u - x)**2 + (v - y)**2 <= radius**2:
+                found.append(entity)
+        return found
@@ -0,0 +1,193 @@
+# font.py: Bitmap text from a sheet of glyphs
+#
+# The glyphs are cut out of the sheet once, as described by a legend like the
+# tile sets, trimmed to the columns they use and put side by side into a
+# glyph atlas. Coloured text uses a copy of the atlas in that colour, made the
+# first time the colour is used. A line of text is composed by blitting its
+# glyphs from the atlas in one call, and the last rendered lines are kept, so
+# text that is shown again (a HUD, the lines of the message log) costs one
+# blit instead of one per glyph.
+#
+# The MessageLog keeps the last lines of the messages in a surface of its
+# own. New messages scroll the surface up and only the new lines are drawn,
+# however many messages there were before.
+
+import os
+import collections
+
+import pygame
+
+import blitter
+from config_cache import read_config
+
+def sheet_file(legend_file):
+    """Returns the image file of the glyphs of the legend 'legend_file'."""
+    return os.path.join(os.path.dirname(legend_file),
+                        read_config(legend_file)["info"]["sheet"] + ".png")
+
+class BitmapFont():
+    """The font described by the legend 'legend_file'. The last 'cache_size'
+    rendered lines are kept. 'sheet' is the decoded image of the glyphs if
+    it was loaded already."""
+    def __init__(self, legend_file, cache_size=256, sheet=None):
+        legend = read_config(legend_file)
+        info = legend["info"]
+        offset_x = int(info["offset_x"])
+        offset_y = int(info["offset_y"])
+        size_x = int(info["size_x"])
+        size_y = int(info["size_y"])
+        self.spacing = int(info["spacing"])
+        self.space_width = int(info["space_width"])
+        self.color = tuple(int(info["color_" + i]) for i in "rgb")
+        self.height = size_y
+        self.cache_size = cache_size
+        self.lines = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if sheet is None:
+            sheet = pygame.image.load(sheet_file(legend_file))
+        if pygame.display.get_surface() is not None:
+            sheet = sheet.convert_alpha()
+
+        # Cut out the glyphs and trim the empty columns on both sides
+        glyphs = collections.OrderedDict()
+        for row, chars in legend["lines"].items():
+            for column, char in enumerate(chars):
+                cell = sheet.subsurface((offset_x + column * size_x, offset_y + int(row) * size_y,
+                                         size_x, size_y))
+                used = cell.get_bounding_rect()
+                glyphs[char] = cell.subsurface((used.left, 0, used.width, size_y))
+
+        # Put the glyphs side by side into the atlas
+        self.atlas = pygame.Surface((max(sum(glyph.get_width() for glyph in glyphs.values()), 1),
+                                     size_y), pygame.SRCALPHA)
+        self.rects = {}
+        x = 0
+        for char, glyph in glyphs.items():
+            self.rects[char] = self.atlas.blit(glyph, (x, 0))
+            x += glyph.get_width()
+        for alias, char in legend["aliases"].items():
+            self.rects[alias] = self.rects[char]
+        self.widths = {char:rect.width + self.spacing for char, rect in self.rects.items()}
+        self.widths[" "] = self.space_width
+        self.glyphs = {}
+
+    def glyphs_in(self, color):
+        """Returns a dictionary of the glyphs in the color 'color', which
+        are made from the atlas the first time."""
+        color = tuple(color)
+        if color not in self.glyphs:
+            atlas = self.atlas.copy()
+            if color != self.color:
+                pixels = pygame.PixelArray(atlas)
+                pixels.replace(self.color + (255,), color[:3] + (255,))
+                del pixels
+            self.glyphs[color] = {char:atlas.subsurface(rect) for char, rect in self.rects.items()}
+        return self.glyphs[color]
+
+    def size(self, text):
+        """Returns the size of 'text' rendered with the font. Characters
+        without glyph are left out."""
+        widths = self.widths
+        width = sum(widths.get(char, 0) for char in text)
+        return (max(width - self.spacing, 0), self.height)
+
+    def render(self, text, color=(248, 248, 248)):
+        """Returns a surface with 'text' in the color 'color'. The surface
+        is shared with later calls and must not be changed."""
+        key = (text, tuple(color))
+        if key in self.lines:
+            self.hits += 1
+            self.lines.move_to_end(key)
+            return self.lines[key]
+        self.misses += 1
+        glyphs = self.glyphs_in(color)
+        widths = self.widths
+        blits = []
+        x = 0
+        for char in text:
+            if char in glyphs:
+                blits.append((glyphs[char], (x, 0)))
+            x += widths.get(char, 0)
+        image = pygame.Surface((max(self.size(text)[0], 1), self.height), pygame.SRCALPHA)
+        blitter.blit_all(image, blits)
+        self.lines[key] = image
+        while len(self.lines) > self.cache_size:
+            self.lines.popitem(last=False)
+        return image
+
+    def wrap(self, text, width):
+        """Returns the lines of 'text' broken between words so that each fits
+        into 'width' pixels if possible."""
+        if self.size(text)[0] <= width:
+            return [text]
+        lines = []
+        line = ""
+        for word in text.split(" "):
+            candidate = line + " " + word if line else word
+            if line and self.size(candidate)[0] > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+        return lines
+
+    def statistics(self):
+        """Returns a dictionary of the line cache statistics."""
+        return {"lines":len(self.lines),
+                "colors":len(self.glyphs),
+                "hits":self.hits,
+                "misses":self.misses,
+               }
+
+class MessageLog():
+    """The last 'lines' lines of messages written with 'font' into a surface
+    'width' pixels wide. Messages are only drawn into the surface when it is
+    drawn the next time, so many messages in one turn cost no more than a
+    full log."""
+    def __init__(self, font, width, lines=4):
+        self.font = font
+        self.lines = lines
+        self.image = pygame.Surface((width, lines * font.height), pygame.SRCALPHA)
+        self.size = self.image.get_size()
+        self.pending = collections.deque(maxlen=lines)
+        self.changed = False
+
+    def add(self, text, color=(248, 248, 248)):
+        """Adds the message 'text' in the color 'color' below the others."""
+        # Every message takes at least one line, so older messages would be
+        # scrolled out before being seen
+        self.pending.append((text, color))
+        self.changed = True
+
+    def update(self):
+        """Scrolls the lines of the log up and draws the new ones below."""
+        if not self.pending:
+            return
+        width = self.image.get_width()
+        lines = [(line, color) for text, color in self.pending
+                 for line in self.font.wrap(text, width)][-self.lines:]
+        self.pending.clear()
+        height = self.font.height
+        count = len(lines)
+        image = self.image
+        image.scroll(0, -count * height)
+        top = (self.lines - count) * height
+        image.fill((0, 0, 0, 0), (0, top, image.get_width(), count * height))
+        blitter.blit_all(image, [(self.font.render(text, color), (0, top + i * height))
+                                 for i, (text, color) in enumerate(lines)])
+
+    def draw(self, surface, position, area=None):
+        """Draws the log onto 'surface' at 'position'. Only the part inside
+        the rectangle 'area' of 'surface' is drawn, all of it by default.
+        Returns the rectangle drawn to."""
+        self.update()
+        self.changed = False
+        rect = self.image.get_rect(topleft=position)
+        if area is not None:
+            rect = rect.clip(area)
+        if rect:
+            surface.blit(self.image, rect, rect.move(-position[0], -position[1]))
+        return rect
@@ -0,0 +1,162 @@
+# fov.py: Field of view by recursive shadowcasting and fog of war
+#
+# The field of view of a tile is found by recursive shadowcasting: Each of the
+# eight octants around the viewer is scanned line by line moving away from
+# it, and opaque tiles cast shadows that are skipped in the following lines.
+# Only tiles within 'radius' are looked at, so the cost does not depend on the
+# size of the level. Fields of view are cached per viewer tile, which makes
+# them cheap enough for every monster every turn; changing a tile only drops
+# the cached fields that could contain it.
+#
+# FogOfWar keeps what the player currently sees and what the player has
+# explored (one bit per tile) and reports the tiles whose visibility changed
+# after a move, so the fog only has to be drawn again there.
+
+import collections
+
+import grid
+
+# Transformations of the coordinates of the first octant into each octant
+OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+           (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+# Visibility of a tile
+UNEXPLORED = 0
+EXPLORED = 1
+VISIBLE = 2
+
+class FieldOfView():
+    """Fields of view on 'level' (anything with a 'grid', e.g. a
+    main02.Level) reaching 'radius' tiles. The fields of the last
+    'cache_size' viewer tiles are kept."""
+    def __init__(self, level, radius, cache_size=256):
+        tiles = level.grid
+        self.grid = tiles
+        self.radius = radius
+        self.cache_size = cache_size
+        self.fields = collections.OrderedDict()
+        self.computed = 0
+
+    def is_opaque(self, u, v):
+        """Returns whether the tile at ('u', 'v') of the grid including its
+        border blocks the view."""
+        tiles = self.grid
+        if 0 <= u < tiles.stride and 0 <= v < tiles.lines:
+            return not tiles.flags[v * tiles.stride + u] & grid.TRANSPARENT
+        return not tiles.flag_table[ord(tiles.default_tile)] & grid.TRANSPARENT
+
+    def compute(self, x, y):
+        """Returns the indices of the grid tiles visible from ('x', 'y') as
+        frozenset."""
+        index = self.grid.index(x, y)
+        if index in self.fields:
+            self.fields.move_to_end(index)
+            return self.fields[index]
+        u = x + self.grid.border_x
+        v = y + self.grid.border_y
+        visible = set()
+        if index >= 0:
+            visible.add(index)
+        for octant in OCTANTS:
+            self.cast_light(visible, u, v, 1, 1.0, 0.0, octant)
+        field = frozenset(visible)
+        self.computed += 1
+        self.fields[index] = field
+        while len(self.fields) > self.cache_size:
+            self.fields.popitem(last=False)
+        return field
+
+    def cast_light(self, visible, u, v, line, start, end, octant):
+        """Adds the tiles of 'octant' between the slopes 'start' and 'end'
+        visible from ('u', 'v') to 'visible', beginning with 'line'."""
+        if start < end:
+            return
+        xx, xy, yx, yy = octant
+        radius = self.radius
+        stride = self.grid.stride
+        lines = self.grid.lines
+        new_start = start
+        for distance in range(line, radius + 1):
+            blocked = False
+            dy = -distance
+            for dx in range(-distance, 1):
+                left = (dx - 0.5) / (dy + 0.5)
+                right = (dx + 0.5) / (dy - 0.5)
+                if start < right:
+                    continue
+                if end > left:
+                    break
+                tile_u = u + dx * xx + dy * xy
+                tile_v = v + dx * yx + dy * yy
+                if (dx * dx + dy * dy <= radius * radius
+                        and 0 <= tile_u < stride and 0 <= tile_v < lines):
+                    visible.add(tile_v * stride + tile_u)
+                opaque = self.is_opaque(tile_u, tile_v)
+                if blocked:
+                    if opaque:
+                        new_start = right
+                    else:
+                        blocked = False
+                        start = new_start
+                elif opaque and distance < radius:
+                    blocked = True
+                    self.cast_light(visible, u, v, distance + 1, start, left, octant)
+                    new_start = right
+            if blocked:
+                return
+
+    def sees(self, viewer, target):
+        """Returns whether the tile 'target' is visible from 'viewer'."""
+        return self.grid.index(*target) in self.compute(*viewer)
+
+    def invalidate(self, x, y):
+        """Drops the cached fields which might change because the tile at
+        ('x', 'y') was changed, i.e. those of viewers within the radius."""
+        index = self.grid.index(x, y)
+        stride = self.grid.stride
+        row, column = divmod(index, stride)
+        for viewer in list(self.fields):
+            v, u = divmod(viewer, stride)
+            if abs(u - column) <= self.radius and abs(v - row) <= self.radius:
+                del self.fields[viewer]
+
+class FogOfWar():
+    """What the player sees through 'field_of_view' and which tiles of its
+    grid have been explored, one bit per tile."""
+    def __init__(self, field_of_view):
+        self.field_of_view = field_of_view
+        self.grid = field_of_view.grid
+        self.visible = frozenset()
+        self.explored = bytearray((len(self.grid.flags) + 7) // 8)
+        self.position = None
+
+    def is_explored(self, index):
+        return bool(self.explored[index >> 3] & (1 << (index & 7)))
+
+    def visibility(self, index):
+        """Returns VISIBLE, EXPLORED or UNEXPLORED for the grid tile
+        'index'."""
+        if index in self.visible:
+            return VISIBLE
+        if self.is_explored(index):
+            return EXPLORED
+        return UNEXPLORED
+
+    def update(self, x, y):
+        """Moves the player to ('x', 'y'). Returns the indices of the grid
+        tiles whose visibility changed."""
+        self.position = (x, y)
+        visible = self.field_of_view.compute(x, y)
+        changed = visible.symmetric_difference(self.visible)
+        explored = self.explored
+        for index in visible:
+            explored[index >> 3] |= 1 << (index & 7)
+        self.visible = visible
+        return changed
+
+    def refresh(self):
+        """Updates the view after a tile was changed. Returns the indices of
+        the grid tiles whose visibility changed."""
+        if self.position is None:
+            return frozenset()
+        return self.update(*self.position)
@@ -0,0 +1,102 @@
+# grid.py: Compact storage of the tiles of a level
+#
+# A Grid stores the type (as character byte), the variation and the flags of
+# every tile in three flat bytearrays. The map is surrounded by a border of
+# default tiles and all three arrays cover the map including this border with
+# the same coordinates: the tile (x, y) of the map is at index
+# (y + border_y) * stride + (x + border_x). Tiles outside of the border are
+# default tiles with variation 0.
+#
+# This takes 3 bytes per tile, i.e. 3 MB per million tiles. A list of
+# strings for the types plus a list of lists of integers for the variations
+# took about 10 MB per million tiles. Run "python benchmark.py --stages
+# memory" to measure it.
+
+# Flags of a tile
+WALKABLE = 1
+TRANSPARENT = 2
+# Flags of each tile type
+TILE_FLAGS = {".":WALKABLE | TRANSPARENT, "o":TRANSPARENT}
+
+class Grid():
+    """The tiles of a map of 'width' times 'height' tiles with a border of
+    'border' (a tuple of the border's width and height) tiles filled with
+    'default_tile'. 'tile_flags' is a dictionary of the flags of each tile
+    type."""
+    __slots__ = ("width", "height", "border_x", "border_y", "stride", "lines",
+                 "default_tile", "flag_table", "types", "variation", "flags")
+
+    def __init__(self, width, height, border, default_tile, tile_flags):
+        self.width = width
+        self.height = height
+        self.border_x, self.border_y = border
+        self.stride = width + 2 * self.border_x
+        self.lines = height + 2 * self.border_y
+        self.default_tile = default_tile
+        self.flag_table = bytearray(256)
+        for char, flags in tile_flags.items():
+            self.flag_table[ord(char)] = flags
+        size = self.stride * self.lines
+        self.types = bytearray(default_tile.encode("ascii")) * size
+        self.variation = bytearray(size)
+        self.flags = bytearray([self.flag_table[ord(default_tile)]]) * size
+
+    def load_map(self, rows):
+        """Sets the types of the map to the strings 'rows'. Missing tiles of
+        short rows are default tiles."""
+        for y, row in enumerate(rows[:self.height]):
+            row = row[:self.width].encode("ascii")
+            start = (y + self.border_y) * self.stride + self.border_x
+            self.types[start:start + len(row)] = row
+            self.flags[start:start + len(row)] = row.translate(self.flag_table)
+
+    def index(self, x, y):
+        """Returns the index of the tile at ('x', 'y') or -1 if it is
+        outside of the border."""
+        u = x + self.border_x
+        v = y + self.border_y
+        if 0 <= u < self.stride and 0 <= v < self.lines:
+            return v * self.stride + u
+        return -1
+
+    def in_map(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get_type(self, x, y):
+        i = self.index(x, y)
+        if i < 0:
+            return self.default_tile
+        return chr(self.types[i])
+
+    def set_type(self, x, y, char):
+        """Changes the type of the tile at ('x', 'y') of the map to 'char'."""
+        if not self.in_map(x, y):
+            raise IndexError("Tile ({0}, {1}) is not on the map.".format(x, y))
+        i = self.index(x, y)
+        self.types[i] = ord(char)
+        self.flags[i] = self.flag_table[ord(char)]
+
+    def get_variation(self, x, y):
+        i = self.index(x, y)
+        if i < 0:
+            return 0
+        return self.variation[i]
+
+    def get_flags(self, x, y):
+        i = self.index(x, y)
+        if i < 0:
+            return self.flag_table[ord(self.default_tile)]
+        return self.flags[i]
+
+    def rows(self):
+        """Returns the types of the map (without border) as list of
+        strings."""
+        rows = []
+        for y in range(self.height):
+            start = (y + self.border_y) * self.stride + self.border_x
+            rows.append(self.types[start:start + self.width].decode("ascii"))
+        return rows
+
+    def nbytes(self):
+        """Returns the number of bytes used by the tile buffers."""
+        return len(self.types) + len(self.variation) + len(self.flags)
@@ -0,0 +1,95 @@
+# loader.py: Loading assets in a pool of threads while the screen is drawn
+#
+# Decoding images and parsing legends mostly waits for the disk and for
+# C code that releases the GIL, so several assets are loaded at the same
+# time in worker threads. Only the last step of each asset, e.g. converting
+# an image to the pixel format of the display, runs on the main thread,
+# which SDL requires. The main thread polls the loader between drawing the
+# frames of a loading screen, which finishes the loaded assets and reports
+# the progress. The time of every asset is kept, split into waiting for a
+# worker, loading and finishing.
+
+import time
+import collections
+import concurrent.futures
+
+class AssetLoader():
+    """Loads assets in 'workers' threads. Progress callbacks are called
+    with the number of finished assets, the number of assets and the name
+    of the asset finished last."""
+    def __init__(self, workers=4):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.jobs = collections.OrderedDict()
+        self.results = {}
+        self.timings = collections.OrderedDict()
+        self.callbacks = []
+        self.start = time.perf_counter()
+
+    def submit(self, name, load, finish=None):
+        """Starts loading the asset 'name' by calling 'load' without
+        arguments in a worker thread. If given, 'finish' is called on the
+        main thread with the result of 'load' and returns the asset. Returns
+        a future of the result of 'load'."""
+        submitted = time.perf_counter()
+        def run():
+            started = time.perf_counter()
+            result = load()
+            return result, started, time.perf_counter()
+        future = self.executor.submit(run)
+        self.jobs[name] = (future, finish, submitted)
+        return future
+
+    def poll(self):
+        """Finishes the assets loaded since the last call on the calling
+        (main) thread. Exceptions of loading and finishing are raised here.
+        Returns whether all assets are finished."""
+        for name, (future, finish, submitted) in list(self.jobs.items()):
+            if not future.done():
+                continue
+            del self.jobs[name]
+            result, started, loaded = future.result()
+            asset = finish(result) if finish is not None else result
+            finished = time.perf_counter()
+            self.results[name] = asset
+            self.timings[name] = {"wait":started - submitted,
+                                  "load":loaded - started,
+                                  "finish":finished - loaded,
+                                  "total":finished - submitted,
+                                 }
+            for callback in self.callbacks:
+                callback(len(self.results), len(self.results) + len(self.jobs), name)
+        return not self.jobs
+
+    def wait(self, interval=1 / 60, callback=None):
+        """Polls until all assets are finished, also those submitted while
+        finishing others. 'callback' is called without arguments about every
+        'interval' seconds in between, e.g. to draw a loading screen."""
+        while not self.poll():
+            if callback is not None:
+                callback()
+            futures = [future for future, finish, submitted in self.jobs.values()]
+            concurrent.futures.wait(futures, interval,
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def progress(self):
+        """Returns the finished fraction of the assets."""
+        total = len(self.results) + len(self.jobs)
+        return len(self.results) / total if total else 1.0
+
+    def result(self, name):
+        return self.results[name]
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def report(self):
+        """Returns lines of text with the time of each asset in milliseconds
+        and the time since the loader was made."""
+        lines = ["{0:<32} {1:>8} {2:>8} {3:>8} {4:>8}".format("asset", "wait", "load",
+                                                              "finish", "total")]
+        for name, timing in self.timings.items():
+            lines.append("{0:<32} {1:8.1f} {2:8.1f} {3:8.1f} {4:8.1f}".format(
+                name, *[timing[i] * 1000 for i in ("wait", "load", "finish", "total")]))
+        lines.append("Loaded {0} assets in {1:.1f} ms.".format(
+            len(self.timings), (time.perf_counter() - self.start) * 1000))
+        return lines
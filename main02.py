@@ -3,8 +3,12 @@
 # main02.py: Trying the pygame tiles tutorial from qq.readthedocs.io
 
 import os
-import configparser
+import collections
+import hashlib
 import random
+import time
+import weakref
+import concurrent.futures
 
 #USING_GUI = True
 USING_GUI = False
@@ -13,8 +17,29 @@ try:
 except ImportError:
     USING_GUI = False
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import pygame
 
+import animation
+import assets
+import atlas
+import blitter
+import dungeon
+import entities
+import font
+import fov
+import grid
+import loader
+import profiler
+import recording
+import simulation
+import timing
+from config_cache import read_config, save_config, parse_bool
+
 # WHAT IS:
 # - a vicinity:
 #    A list of three three character strings containing only the characters
@@ -22,16 +47,47 @@ import pygame
 # - a vicinity code:
 #    A string of three characters determining the type of vicinity of a given
 #    tile. Useful for loading the right tile graphic.
+# - a neighbour bitmask:
+#    An integer from 0 to 255 with one bit for each of the eight NEIGHBOURS
+#    of a tile. A bit is set if that neighbour is similar to the tile.
 
 FOLDERS = {"LEVELS":"levels",
            "MAPS":"tile_sets/maps",
            "AVATARS":"tile_sets/avatars",
           }
-constants = configparser.ConfigParser()
-constants.read("constants/constants.ini")
-VICINITY_MASKS = {option:constants["masks"][option].split() for option in constants.options("masks")}
-SCREEN_SIZE = tuple([constants["info"].getint("screen_size_" + i) for i in "xy"])
-BORDER = tuple([constants["info"].getint("border_" + i) for i in "xy"])
+PLAYER_FILE = "players/test01.ini"
+constants = read_config("constants/constants.ini")
+VICINITY_MASKS = {option:mask.split() for option, mask in constants["masks"].items()}
+SCREEN_SIZE = tuple([int(constants["info"]["screen_size_" + i]) for i in "xy"])
+BORDER = tuple([int(constants["info"]["border_" + i]) for i in "xy"])
+CHUNK_SIZE = int(constants["background"]["chunk_size"])
+CHUNK_MEMORY_BUDGET = int(constants["background"]["memory_budget"])
+RENDER_MODE = constants["background"]["render_mode"]
+BLIT_MODE = constants["background"]["blit_mode"]
+ASSET_MEMORY_BUDGET = int(constants["assets"]["memory_budget"])
+PROFILER_ENABLED = parse_bool(constants["profiler"]["enabled"])
+PROFILER_OVERLAY = parse_bool(constants["profiler"]["overlay"])
+PROFILER_CAPACITY = int(constants["profiler"]["capacity"])
+PROFILER_OUTPUT = constants["profiler"]["output"]
+DUNGEON_FLOORS = int(constants["dungeon"]["floors"])
+DUNGEON_SIZE = tuple([int(constants["dungeon"]["size_" + i]) for i in "xy"])
+DUNGEON_SEED = constants["dungeon"]["seed"] or None
+ENTITY_BUCKET_SIZE = int(constants["entities"]["bucket_size"])
+WATER_RATE = int(constants["water"]["rate"])
+FONT_LEGEND = constants["font"]["legend"]
+FONT_CACHE_SIZE = int(constants["font"]["cache_size"])
+LOG_LINES = int(constants["font"]["log_lines"])
+RECORDING_ENABLED = parse_bool(constants["replay"]["record"])
+RECORDING_FOLDER = constants["replay"]["folder"]
+CHECKPOINT_INTERVAL = int(constants["replay"]["checkpoint_interval"])
+LOGIC_RATE = int(constants["timing"]["logic_rate"])
+MAX_FPS = int(constants["timing"]["max_fps"])
+MAX_FRAME_SKIP = int(constants["timing"]["max_frame_skip"])
+MOVE_FRAMES = int(constants["timing"]["move_frames"])
+MINIMAP_SCALES = tuple(int(scale) for scale in constants["minimap"]["scales"].split())
+MINIMAP_SIZE = tuple([int(constants["minimap"]["size_" + i]) for i in "xy"])
+MINIMAP_ENABLED = parse_bool(constants["minimap"]["show"])
+LOADER_WORKERS = int(constants["loader"]["workers"])
 del constants
 DIRECTIONS = "wasd"
 TILE_CODES = {"X0":("walls", "default"),
@@ -41,23 +97,57 @@ TILE_CODES = {"X0":("walls", "default"),
               ".1":("ground", "alternate1"),
               ".2":("ground", "alternate2"),
               ".3":("ground", "unused"),
-              "o0":("water", "default")
+              "o0":("water", "default"),
+              "o1":("water", "sparkle")
              }
+# Animation frames of animated tile types (the first one is the static tile)
+ANIMATED_CODES = {"o":["o0", "o1"]}
 TILE_VARIATION_NUMBER = {"X":3,
                          ".":4,
                          "o":1
                         }
 VARIATION_GGT = 12
+# Maps a random byte to a variation. The bytes from the largest multiple of
+# VARIATION_GGT on are dropped, so all variations are equally likely.
+VARIATION_LIMIT = 256 - 256 % VARIATION_GGT
+VARIATION_TABLE = bytes(i % VARIATION_GGT for i in range(256))
+VARIATION_REJECTED = bytes(range(VARIATION_LIMIT, 256))
 SIMILAR = {"X":"X",
            ".":".o",
            "o":"o"}
+# Phases of a frame timed by the profiler
+FRAME_PHASES = ["events", "update", "clear", "background", "draw", "present"]
+# Colour of the fog over tiles by their visibility
+FOG_COLORS = {fov.UNEXPLORED:(0, 0, 0, 255),
+              fov.EXPLORED:(0, 0, 0, 128),
+              fov.VISIBLE:(0, 0, 0, 0)}
+# Minimap colors of the tile types unless a level sets them with "color"
+MINIMAP_COLORS = {".":"white", "X":"black", "o":"grey"}
+MINIMAP_MARKER = (248, 80, 80)
+# Decoded tile sheets and composed tile sets shared by all levels and sprites
+ASSET_CACHE = assets.AssetCache(ASSET_MEMORY_BUDGET)
+# Offsets of the eight neighbours of a tile. The n-th neighbour sets the n-th
+# bit of the neighbour bitmask of a tile.
+NEIGHBOURS = ((-1, -1), (0, -1), (1, -1),
+              (-1, 0),           (1, 0),
+              (-1, 1),  (0, 1),  (1, 1))
 
 def transform(player, tile_size):
     def coordinates(x, y):
-        return ((SCREEN_SIZE[0] - tile_size[0])//2 + tile_size[0] * (x - player.x),
-                (SCREEN_SIZE[1] - tile_size[1])//2 + tile_size[1] * (y - player.y))
+        return ((SCREEN_SIZE[0] - tile_size[0])//2 + round(tile_size[0] * (x - player.x)),
+                (SCREEN_SIZE[1] - tile_size[1])//2 + round(tile_size[1] * (y - player.y)))
     return coordinates
 
+def count_pixels(rects, bounds):
+    """Returns the number of pixels inside 'bounds' covered by the
+    rectangles 'rects'. Overlapping pixels are counted for every rectangle,
+    just like they are updated for every rectangle."""
+    total = 0
+    for rect in rects:
+        rect = bounds.clip(rect)
+        total += rect.width * rect.height
+    return total
+
 def ask_for_file(directory,extension,question, name_only=False):
     """Asks user via console to choose from all files in directory 'directory'
     with extension 'extension' using the prompt 'question'."""
@@ -92,17 +182,30 @@ def ask_for_file(directory,extension,question, name_only=False):
     print("Option {0} selected.".format(option))
     return return_string.format(option)
 
+def sheet_key(filename, colorkey=None):
+    return ("sheet", filename, tuple(colorkey or ()))
+
+def convert_sheet(image, colorkey=None):
+    """Converts the decoded image 'image' to the format of the screen and
+    returns it together with its size in bytes. If a color 'colorkey' is
+    given all pixels with this color will be transparent."""
+    image = image.convert()
+    if colorkey != None:
+        image.set_colorkey(colorkey)
+    return image, assets.surface_bytes(image)
+
+def load_sheet(filename, colorkey=None):
+    """Loads the image 'filename', see convert_sheet."""
+    return convert_sheet(pygame.image.load(filename), colorkey)
+
 def load_tile_file(filename, position_directory, size, colorkey=None):
     """Loads tiles from 'filename' where 'position_directory' is a directory
     containing the positions of the tiles and 'size' is a tuple of the tiles'
     size. If a color 'colorkey' is given all pixels with this color will be
     loaded as transparent."""
-    # Load file as PyGame image
-    image = pygame.image.load(filename).convert()
-
-    # Make certain pixels transparent
-    if colorkey != None:
-        image.set_colorkey(colorkey)
+    # Load file as PyGame image and make certain pixels transparent
+    image = ASSET_CACHE.get(sheet_key(filename, colorkey),
+                            lambda: load_sheet(filename, colorkey))
 
     # Load tiles into new dictionary
     tile_directory = {}
@@ -113,37 +216,147 @@ def load_tile_file(filename, position_directory, size, colorkey=None):
 
     return tile_directory
 
+def load_animation(filename, positions, size, colorkey=None, rate=6):
+    """Returns the animation.Animation of the tiles of 'filename' at
+    'positions' (a list), each shown for 'rate' ticks. See load_tile_file
+    for 'size' and 'colorkey'. Each animation is only loaded once and then
+    shared by all sprites showing it."""
+    key = ("animation", filename, tuple(tuple(position) for position in positions),
+           tuple(size), tuple(colorkey or ()), rate)
+    def load():
+        tiles = load_tile_file(filename, dict(enumerate(positions)), size, colorkey)
+        # The frames are subsurfaces of the cached sheet and take no memory
+        return animation.Animation([tiles[i] for i in range(len(positions))], rate), 0
+    return ASSET_CACHE.get(key, load)
+
+def load_font(legend_file, sheet=None):
+    """Returns the font.BitmapFont described by 'legend_file'. Each font is
+    only loaded once, so its cached lines are shared. 'sheet' is the
+    decoded glyph sheet if it was loaded already."""
+    def load():
+        loaded = font.BitmapFont(legend_file, FONT_CACHE_SIZE, sheet)
+        return loaded, assets.surface_bytes(loaded.atlas)
+    return ASSET_CACHE.get(("font", legend_file), load)
+
+def load_scaled_tile_set(tile_set_name, legend, scale):
+    """Returns the tiles of the tile set 'tile_set_name' with legend 'legend'
+    shrunk to 1/'scale' of their size. Tiles shared by several codes are
+    only shrunk once."""
+    return ASSET_CACHE.get(("scaled_tile_set", tile_set_name, legend_key(legend), scale),
+                           lambda: scale_tiles(load_tile_set(tile_set_name, legend), scale))
+
+def scale_tiles(tiles, scale):
+    """Returns the tile directory 'tiles' with the tiles shrunk to
+    1/'scale' of their size and the size of the shrunk tiles in bytes."""
+    scaled = {}
+    shrunk = {}
+    size = 0
+    for code, tile in tiles.items():
+        key = (id(tile.get_abs_parent()), tile.get_abs_offset(), tile.get_size())
+        if key not in shrunk:
+            width, height = tile.get_size()
+            shrunk[key] = pygame.transform.smoothscale(
+                tile, (max(width // scale, 1), max(height // scale, 1)))
+            size += assets.surface_bytes(shrunk[key])
+        scaled[code] = shrunk[key]
+    return scaled, size
+
+def legend_key(legend):
+    """Returns the contents of the legend 'legend' as a tuple that can be
+    used as dictionary key."""
+    return tuple((section, tuple(options.items())) for section, options in legend.items())
+
+def legend_sources(tile_set_name):
+    """Returns the files the tile set 'tile_set_name' is made from."""
+    return [FOLDERS["MAPS"] + "/{0}.leg".format(name) for name in ["default", tile_set_name]]
+
+def load_legend(tile_set_name):
+    """Reads the legend of the tile set 'tile_set_name' on top of the
+    default legend."""
+    return read_config(legend_sources(tile_set_name))
+
+def atlas_file_name(tile_set_name):
+    return FOLDERS["MAPS"] + "/{0}.atlas".format(tile_set_name)
+
+def tile_set_sources(tile_set_name):
+    return legend_sources(tile_set_name) + [FOLDERS["MAPS"] + "/{0}.png".format(tile_set_name)]
+
+def legend_hash(legend):
+    """Returns a hash of the legend 'legend' and the tile codes composed
+    with it."""
+    key = (legend_key(legend), sorted(TILE_CODES.items()))
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+def bake_tile_set(tile_set_name, legend):
+    """Composes the tiles of the tile set 'tile_set_name' and saves them as
+    atlas. Returns the tiles together with their size in bytes."""
+    tile_directory, size = compose_tile_set(tile_set_name, legend)
+    try:
+        atlas.save_atlas(atlas_file_name(tile_set_name), tile_directory,
+                         tile_set_sources(tile_set_name), legend_hash(legend))
+    except OSError as error:
+        print("Could not save atlas: {0}".format(error))
+    return tile_directory, size
+
+def load_baked_tile_set(tile_set_name, legend):
+    """Loads the tiles of the tile set 'tile_set_name' from its atlas. If
+    the atlas is missing or outdated, it is baked first."""
+    baked = atlas.load_atlas(atlas_file_name(tile_set_name),
+                             tile_set_sources(tile_set_name), legend_hash(legend))
+    if baked is None:
+        baked = bake_tile_set(tile_set_name, legend)
+    return baked
+
 def load_tile_set(tile_set_name, legend):
+    """Returns the tiles of the tile set 'tile_set_name' with legend
+    'legend'. Tile sets are only loaded once and then taken from the asset
+    cache. The returned directory must not be changed."""
+    return ASSET_CACHE.get(("tile_set", tile_set_name, legend_key(legend)),
+                           lambda: load_baked_tile_set(tile_set_name, legend))
+
+def compose_tile_set(tile_set_name, legend):
     """Reads the INI of the tile set 'tile_set_name' to properly extract the
-    tiles from the image files."""
+    tiles from the image files. Returns the tiles together with the size in
+    bytes of the composed tiles."""
     # Read size and colorkey
-    offset_x = legend["info"].getint("offset_x")
-    offset_y = legend["info"].getint("offset_y")
-    size_x = legend["info"].getint("size_x")
-    size_y = legend["info"].getint("size_y")
-    colorkey_r = legend["info"].getint("colorkey_r")
-    colorkey_g = legend["info"].getint("colorkey_g")
-    colorkey_b = legend["info"].getint("colorkey_b")
-    margin_x = legend["info"].getint("margin_x")
-    margin_y = legend["info"].getint("margin_y")
+    offset_x = int(legend["info"]["offset_x"])
+    offset_y = int(legend["info"]["offset_y"])
+    size_x = int(legend["info"]["size_x"])
+    size_y = int(legend["info"]["size_y"])
+    colorkey_r = int(legend["info"]["colorkey_r"])
+    colorkey_g = int(legend["info"]["colorkey_g"])
+    colorkey_b = int(legend["info"]["colorkey_b"])
+    margin_x = int(legend["info"]["margin_x"])
+    margin_y = int(legend["info"]["margin_y"])
     offset = (offset_x, offset_y)
     colorkey = (colorkey_r, colorkey_g, colorkey_b)
 
-    # Make position directory
-    position_directory = {}
+    # Make position directories, one for each colorkey. A column may have
+    # a colorkey of its own, e.g. "sparkle_colorkey_r".
+    position_directories = {}
     for code, tile_type in TILE_CODES.items():
+        if tile_type[1] not in legend[tile_type[0]]:
+            continue
+        if tile_type[1] + "_colorkey_r" in legend["info"]:
+            tile_colorkey = tuple(int(legend["info"][tile_type[1] + "_colorkey_" + i])
+                                  for i in "rgb")
+        else:
+            tile_colorkey = colorkey
+        position_directory = position_directories.setdefault(tile_colorkey, {})
         for mask in VICINITY_MASKS:
             for direction in DIRECTIONS:
-                if tile_type[1] in legend[tile_type[0]]:
-                    # offset, size, margin, column and line
-                    dx_type = legend[tile_type[0]].getint(tile_type[1])
-                    dx_vicinity = legend["tile_table"].getint(mask + direction + "x")
-                    dy_vicinity = legend["tile_table"].getint(mask + direction + "y")
-                    x = offset_x + (size_x + margin_x) * (3 * dx_type + dx_vicinity)
-                    y = offset_y + (size_y + margin_y) * dy_vicinity
-                    position_directory[code+mask+direction] = (x, y)
+                # offset, size, margin, column and line
+                dx_type = int(legend[tile_type[0]][tile_type[1]])
+                dx_vicinity = int(legend["tile_table"][mask + direction + "x"])
+                dy_vicinity = int(legend["tile_table"][mask + direction + "y"])
+                x = offset_x + (size_x + margin_x) * (3 * dx_type + dx_vicinity)
+                y = offset_y + (size_y + margin_y) * dy_vicinity
+                position_directory[code+mask+direction] = (x, y)
     filename = FOLDERS["MAPS"] + "/{0}.png".format(tile_set_name)
-    tile_directory = load_tile_file(filename, position_directory, (size_x, size_y), colorkey)
+    tile_directory = {}
+    for tile_colorkey, position_directory in position_directories.items():
+        tile_directory.update(load_tile_file(filename, position_directory, (size_x, size_y),
+                                             tile_colorkey))
     for code, tile_type in TILE_CODES.items():
         for mask in VICINITY_MASKS:
             for direction in DIRECTIONS:
@@ -152,7 +365,9 @@ def load_tile_set(tile_set_name, legend):
                     if tile_type[1] in legend[tile_type[0]]:
                         test.blit(tile_directory[code+mask+direction], (0,0))
                     tile_directory[code+mask+direction] = test
-    return tile_directory
+    # The tiles of the default variations are subsurfaces of the sheet,
+    # which they keep alive
+    return tile_directory, assets.pixels_bytes(tile_directory.values())
 
 def turn_vicinity(vicinity,direction):
     """Takes a vicinity 'vicinity' and turns it according to 'direction': "w" is no turn,
@@ -174,59 +389,145 @@ def check_vicinity(vicinity, mask, direction):
     mask = turn_vicinity(mask, direction)
     return all(all(mask[i][j] in vicinity[i][j]+"/" for j in range(3)) for i in range(3))
 
+def vicinity_from_bitmask(bitmask):
+    """Returns the vicinity described by the 8-bit neighbour bitmask
+    'bitmask'. Bit i is set if the i-th neighbour in NEIGHBOURS is similar to
+    the tile in the middle, which itself is always similar."""
+    cells = [[1 if (dx, dy) == (0, 0) else 0 for dx in (-1, 0, 1)] for dy in (-1, 0, 1)]
+    for bit, (dx, dy) in enumerate(NEIGHBOURS):
+        cells[dy + 1][dx + 1] = (bitmask >> bit) & 1
+    return ["".join(str(cell) for cell in row) for row in cells]
+
+def build_vicinity_table():
+    """Matches every possible neighbour bitmask against the vicinity masks
+    and returns a list of 256 vicinity codes. Masks and directions are tried
+    in the order of VICINITY_MASKS and DIRECTIONS and the first match wins. Bitmasks matching
+    no mask at all map to None."""
+    table = []
+    for bitmask in range(256):
+        vicinity = vicinity_from_bitmask(bitmask)
+        code = None
+        for maskname, mask in VICINITY_MASKS.items():
+            for direction in DIRECTIONS:
+                if check_vicinity(vicinity, mask, direction):
+                    code = maskname + direction
+                    break
+            if code is not None:
+                break
+        table.append(code)
+    return table
+
+VICINITY_TABLE = build_vicinity_table()
+
+def build_code_arrays():
+    """Returns NumPy lookup arrays for the batch classification of tiles.
+    The arrays are indexed by the byte value of a tile character (and the
+    byte value of a neighbouring character or a variation resp. neighbour
+    bitmask) and contain whether a neighbour is similar, the number of
+    variations, the row in the code table and finally the tile codes."""
+    tile_types = sorted(TILE_VARIATION_NUMBER)
+    similar = numpy.zeros((256, 256), dtype=numpy.uint8)
+    variation_number = numpy.ones(256, dtype=numpy.int64)
+    type_index = numpy.full(256, -1, dtype=numpy.int64)
+    codes = numpy.empty((len(tile_types), max(TILE_VARIATION_NUMBER.values()), 256),
+                        dtype=object)
+    for index, tile_type in enumerate(tile_types):
+        for other in SIMILAR[tile_type]:
+            similar[ord(tile_type), ord(other)] = 1
+        variation_number[ord(tile_type)] = TILE_VARIATION_NUMBER[tile_type]
+        type_index[ord(tile_type)] = index
+        for variation in range(TILE_VARIATION_NUMBER[tile_type]):
+            for bitmask, vicinity_code in enumerate(VICINITY_TABLE):
+                codes[index, variation, bitmask] = (tile_type + str(variation)
+                                                    + (vicinity_code or "4fa"))
+    return similar, variation_number, type_index, codes.astype(str)
+
+if numpy is not None:
+    SIMILAR_ARRAY, VARIATION_NUMBER_ARRAY, TYPE_INDEX_ARRAY, CODE_ARRAY = build_code_arrays()
+
+def random_variations(size):
+    """Returns 'size' random variations as bytes, from 0 to VARIATION_GGT - 1
+    each."""
+    variations = b""
+    while len(variations) < size:
+        # Draw a few more bytes than missing, as some are dropped
+        count = (size - len(variations)) * 256 // VARIATION_LIMIT + 8
+        variations += random.getrandbits(8 * count).to_bytes(count, "little").translate(
+            VARIATION_TABLE, VARIATION_REJECTED)
+    return variations[:size]
+
+def level_tile_set(level_file):
+    """Returns the tile set of the level 'level_file'. If the level asks
+    for one, the user is asked."""
+    tile_set = read_config(level_file)["level"]["tile_set"]
+    if tile_set == "ask":
+        question = "Which tile set would you like to use?" 
+        tile_set = ask_for_file(FOLDERS["MAPS"], ".png", question, True)
+    return tile_set
+
 class Level():
     """This is the raw class for a single map the player can navigate through."""
-    def load_file(self, filename):
-        """Loads configuration from 'filename'."""
-        # Initialize configuration parser
-        parser = configparser.ConfigParser()
-        parser.read(filename)
+    def load_file(self, filename, tile_set=None):
+        """Loads configuration from 'filename'. If 'tile_set' is given, it
+        is used instead of the tile set of the level."""
+        # Read compiled configuration
+        config = read_config(filename)
 
         # Load map
-        self.map = parser.get("level", "map").split("\n")
-        self.width = len(self.map[0])
-        self.height = len(self.map)
-        self.default_tile = parser.get("level","default_tile")
-
-        self.player_position = [int(parser.get("player",i)) for i in "xy"]
-        self.stairs_position = [int(parser.get("stairs",i)) for i in "xy"]
-        self.tile_set = parser.get("level", "tile_set")
-        if self.tile_set == "ask":
-            question = "Which tile set would you like to use?" 
-            self.tile_set = ask_for_file(FOLDERS["MAPS"], ".png", question, True)
-        self.variation = [[random.randint(0,VARIATION_GGT-1)
-            for j in range(self.height + 2 * BORDER[1])] for i in range(self.width + 2 * BORDER[1])]
+        if tile_set is None:
+            tile_set = level_tile_set(filename)
+        self.load_data(config["level"]["map"].split("\n"),
+                       config["level"]["default_tile"],
+                       [int(config["player"][i]) for i in "xy"],
+                       [int(config["stairs"][i]) for i in "xy"],
+                       tile_set)
+        for char, section in config.items():
+            if len(char) == 1 and "color" in section:
+                self.colors[char] = section["color"]
+
+    def load_data(self, level_map, default_tile, player_position, stairs_position, tile_set):
+        """Loads the map 'level_map', a list of strings, and the other level
+        data directly instead of from a file."""
+        self.width = len(level_map[0])
+        self.height = len(level_map)
+        self.default_tile = default_tile
+        self.grid = grid.Grid(self.width, self.height, BORDER, default_tile, grid.TILE_FLAGS)
+        self.grid.load_map(level_map)
+
+        self.player_position = player_position
+        self.stairs_position = stairs_position
+        self.tile_set = tile_set
+        size = len(self.grid.variation)
+        self.grid.variation[:] = random_variations(size)
+        # Player, stairs, items, traps and monsters
+        self.entities = entities.SpatialIndex(ENTITY_BUCKET_SIZE)
+        # Rendered backgrounds to keep up to date when tiles are changed
+        self.images = weakref.WeakSet()
+        self.backgrounds = weakref.WeakSet()
+        self.animated_layers = weakref.WeakSet()
+        # Minimap and zoomed out backgrounds, made when first needed
+        self.colors = dict(MINIMAP_COLORS)
+        self.pyramid = None
         # Loads tile set from file
-        self.legend = configparser.ConfigParser()
-        self.legend.read([FOLDERS["MAPS"] + "/{0}.leg".format(name) for name in ["default", self.tile_set]])
-        tile_size_x = self.legend["info"].getint("size_x")
-        tile_size_y = self.legend["info"].getint("size_y")
+        self.legend = load_legend(self.tile_set)
+        tile_size_x = int(self.legend["info"]["size_x"])
+        tile_size_y = int(self.legend["info"]["size_y"])
         self.tile_size = (tile_size_x, tile_size_y)
         self.dimensions = (self.width * tile_size_x,  self.height * tile_size_y)
 
+    @property
+    def map(self):
+        """The map as list of strings. It is built from the grid on every
+        access, so use get_tile_type to look up single tiles."""
+        return self.grid.rows()
+
     def get_tile_type(self, x, y):
         """ Gets type of the tile at ('x', 'y')."""
-        if not ((0 <= x < self.width) and (0 <= y < self.height)):
-            char = self.default_tile
-        else:
-            try:
-                char = self.map[y][x]
-            except IndexError:
-                char = self.default_tile
-        return char
+        return self.grid.get_type(x, y)
 
     def get_tile_variation(self, x, y):
-        """ Gets type of the tile at ('x', 'y')."""
-        #if not (0<=x<self.width  + 2 * BORDER[1] and 0<=y<self.height + 2 * BORDER[1]):
-        if not ((-BORDER[0] <= x <= self.width + BORDER[0])
-                and (-BORDER[1] <= y <= self.height + BORDER[1])):
-            var = 0
-        else:
-            try:
-                var = self.variation[x - BORDER[0]][y - BORDER[1]]
-            except IndexError:
-                var = 0
-        return var
+        """ Gets variation of the tile at ('x', 'y')."""
+        return self.grid.get_variation(x, y)
 
     def get_tile_type_variant(self, x, y):
         tile_type = self.get_tile_type(x, y)
@@ -236,22 +537,81 @@ class Level():
     def get_tile_vicinity(self, x, y):
         """ Returns the vicinity type of the tile at ('x', 'y') as vicinity
         code."""
-        # Determine vicinity of tile at position (x, y)
-        tile_type = self.get_tile_type(x, y)
-        vicinity = ["".join([str(int(self.get_tile_type(x+i,y+j) in SIMILAR[tile_type]))
-            for i in (-1,0,1)]) for j in (-1,0,1)]
-        # Check it against the vicinity masks
-        for maskname,mask in VICINITY_MASKS.items():
-            for direction in DIRECTIONS:
-                #print(vicinity, mask, direction)
-                if check_vicinity(vicinity, mask, direction):
-                    return maskname+direction
-        print("Vicinity check failed!")
-        return "4fa"
+        # Determine neighbour bitmask of tile at position (x, y)
+        similar = SIMILAR[self.get_tile_type(x, y)]
+        bitmask = 0
+        for bit, (dx, dy) in enumerate(NEIGHBOURS):
+            if self.get_tile_type(x + dx, y + dy) in similar:
+                bitmask |= 1 << bit
+        # Look it up in the precomputed vicinity table
+        code = VICINITY_TABLE[bitmask]
+        if code is None:
+            print("Vicinity check failed!")
+            return "4fa"
+        return code
 
     def get_tile_code(self, x, y):
         return self.get_tile_type_variant(x, y) + self.get_tile_vicinity(x, y)
 
+    def get_grid_array(self, buffer, fill, x0, y0, x1, y1):
+        """Returns the rectangle from ('x0', 'y0') to ('x1', 'y1') (exclusive)
+        of the grid buffer 'buffer' as NumPy array indexed by
+        [y - y0, x - x0]. Tiles outside the grid are 'fill'."""
+        tiles = self.grid
+        result = numpy.full((y1 - y0, x1 - x0), fill, dtype=numpy.uint8)
+        whole = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(tiles.lines, tiles.stride)
+        u0 = max(x0 + tiles.border_x, 0)
+        u1 = min(x1 + tiles.border_x, tiles.stride)
+        v0 = max(y0 + tiles.border_y, 0)
+        v1 = min(y1 + tiles.border_y, tiles.lines)
+        if u0 < u1 and v0 < v1:
+            result[v0 - tiles.border_y - y0:v1 - tiles.border_y - y0,
+                   u0 - tiles.border_x - x0:u1 - tiles.border_x - x0] = whole[v0:v1, u0:u1]
+        return result
+
+    def get_type_array(self, x0, y0, x1, y1):
+        """Returns the tile types of the rectangle from ('x0', 'y0') to
+        ('x1', 'y1') (exclusive) as NumPy array of character bytes, indexed
+        by [y - y0, x - x0]. Tiles outside the map are the default tile."""
+        return self.get_grid_array(self.grid.types, ord(self.default_tile), x0, y0, x1, y1)
+
+    def get_variation_array(self, x0, y0, x1, y1):
+        """Returns the tile variations of the rectangle from ('x0', 'y0') to
+        ('x1', 'y1') (exclusive) as NumPy array indexed by [y - y0, x - x0]."""
+        return self.get_grid_array(self.grid.variation, 0, x0, y0, x1, y1)
+
+    def get_tile_codes(self, area=None):
+        """Returns the tile codes of all tiles in 'area', a tuple (x, y,
+        width, height) that defaults to the map including its border. The
+        codes are indexed by [y - area_y][x - area_x] and are equal to the
+        ones returned by 'get_tile_code'. With NumPy installed, all tiles
+        are classified at once and a NumPy array is returned."""
+        if area is None:
+            area = (-BORDER[0], -BORDER[1],
+                    self.width + 2 * BORDER[0], self.height + 2 * BORDER[1])
+        x0, y0, width, height = area
+        x1, y1 = x0 + width, y0 + height
+        if numpy is None:
+            return [[self.get_tile_code(x, y) for x in range(x0, x1)]
+                    for y in range(y0, y1)]
+
+        # Tile types including a ring of neighbours around the area
+        types = self.get_type_array(x0 - 1, y0 - 1, x1 + 1, y1 + 1)
+        center = types[1:-1, 1:-1]
+        unknown = TYPE_INDEX_ARRAY[center] < 0
+        if unknown.any():
+            raise KeyError(chr(center[unknown][0]))
+
+        # Neighbour bitmasks by shifting the type array in all directions
+        bitmask = numpy.zeros(center.shape, dtype=numpy.uint8)
+        for bit, (dx, dy) in enumerate(NEIGHBOURS):
+            neighbour = types[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+            bitmask |= SIMILAR_ARRAY[center, neighbour] << bit
+
+        variation = (self.get_variation_array(x0, y0, x1, y1)
+                     % VARIATION_NUMBER_ARRAY[center])
+        return CODE_ARRAY[TYPE_INDEX_ARRAY[center], variation, bitmask]
+
     def render(self):
         """Renders the level map onto a PyGame surface and returns it."""
         # Load tile set
@@ -262,37 +622,482 @@ class Level():
         size_x = (self.width + 2 * BORDER[0]) * self.tile_size[0]
         size_y = (self.height + 2 * BORDER[1]) * self.tile_size[1]
         image = pygame.Surface((size_x, size_y))
-        for y in range(-BORDER[1], self.height + BORDER[1]):
-            for x in range(-BORDER[0], self.width + BORDER[0]):
-                tile = self.tile_directory[self.get_tile_code(x, y)]
-                image.blit(tile, ((x + BORDER[0]) * self.tile_size[0],
-                    (y + BORDER[1]) * self.tile_size[1])) #, tile_size, tile_size))
+        codes = self.get_tile_codes()
+        blitter.blit_all(image, blitter.tile_blits(self.tile_directory, codes, self.tile_size),
+                         BLIT_MODE == "batched")
+        self.images.add(image)
         return image
 
-class MySprite(pygame.sprite.Sprite):
-    def __init__(self, position=(0, 0), frames=None, rate=6):
-        super().__init__()
-        self.frames = frames
-        self.image = frames[0]
-        self.rect = pygame.Rect(128-12, 96-12, 24, 24)
+    def render_chunked(self, chunk_size=CHUNK_SIZE, memory_budget=CHUNK_MEMORY_BUDGET):
+        """Returns a ChunkedBackground of the level map. Unlike 'render', no
+        tiles are blitted until they are visible."""
+        self.tile_directory = load_tile_set(self.tile_set, self.legend)
+        background = ChunkedBackground(self, chunk_size, memory_budget)
+        self.backgrounds.add(background)
+        return background
+
+    def render_pyramid(self, scales=()):
+        """Returns the LevelPyramid of the level with at least the zoomed
+        out backgrounds of 'scales'. It is only made once, scales missing
+        from it are added, and it is kept up to date when tiles are
+        changed."""
+        if self.pyramid is None:
+            self.pyramid = LevelPyramid(self, scales)
+        else:
+            missing = [scale for scale in scales if scale not in self.pyramid.images]
+            if missing:
+                codes = self.get_tile_codes()
+                for scale in missing:
+                    self.pyramid.render_scale(scale, codes)
+        return self.pyramid
+
+    def render_animated(self, rate=WATER_RATE, codes=None):
+        """Returns an AnimatedLayer of the animated tiles (e.g. water) of the
+        level. It has to be drawn over a background of the level. 'codes'
+        are the tile codes from 'get_tile_codes', if already known."""
+        self.tile_directory = load_tile_set(self.tile_set, self.legend)
+        layer = AnimatedLayer(self, rate, codes=codes)
+        self.animated_layers.add(layer)
+        return layer
+
+    def set_tile(self, x, y, char):
+        """Changes the tile at ('x', 'y') to 'char'. Only the tile and its
+        neighbours are classified again and the tiles whose code changed are
+        blitted again onto all backgrounds rendered before. Returns the
+        rectangles of these tiles relative to the top left corner of the
+        background (including its border)."""
+        if char not in TILE_VARIATION_NUMBER:
+            # Checked before the grid changes, so the level stays intact
+            raise KeyError(char)
+        area = (x - 1, y - 1, 3, 3)
+        old_codes = self.get_tile_codes(area)
+        self.grid.set_type(x, y, char)
+        new_codes = self.get_tile_codes(area)
+
+        rects = []
+        for j in range(3):
+            for i in range(3):
+                if old_codes[j][i] != new_codes[j][i]:
+                    rects.append(self.redraw_tile(x - 1 + i, y - 1 + j, new_codes[j][i]))
+        return rects
+
+    def redraw_tile(self, x, y, code):
+        """Blits the tile with code 'code' at ('x', 'y') onto all backgrounds
+        rendered before. Returns its rectangle relative to the top left
+        corner of the background."""
+        rect = pygame.Rect((x + BORDER[0]) * self.tile_size[0], (y + BORDER[1]) * self.tile_size[1],
+                           self.tile_size[0], self.tile_size[1])
+        if self.images or self.backgrounds:
+            tile = self.tile_directory[code]
+            for image in self.images:
+                image.blit(tile, rect)
+            for background in self.backgrounds:
+                background.redraw_tile(x, y, tile)
+        for layer in self.animated_layers:
+            layer.update_tile(x, y, code)
+        if self.pyramid is not None:
+            self.pyramid.update_tile(x, y, code)
+        return rect
+
+class ChunkedBackground():
+    """The level map including its border, split into square chunks of
+    'chunk_size' tiles. Chunks are rendered on demand when they are drawn and
+    the least recently drawn ones are dropped as soon as all rendered chunks
+    take up more than 'memory_budget' bytes."""
+    def __init__(self, level, chunk_size=CHUNK_SIZE, memory_budget=CHUNK_MEMORY_BUDGET):
+        self.level = level
+        self.chunk_size = chunk_size
+        self.memory_budget = memory_budget
+        self.columns = level.width + 2 * BORDER[0]
+        self.lines = level.height + 2 * BORDER[1]
+        self.chunks = collections.OrderedDict()
+        self.memory = 0
+        self.position = (0, 0)
+
+    def render_chunk(self, i, j):
+        """Renders the chunk in column 'i' and line 'j' of chunks and returns
+        it as PyGame surface."""
+        tile_x, tile_y = self.level.tile_size
+        x = i * self.chunk_size
+        y = j * self.chunk_size
+        width = min(self.chunk_size, self.columns - x)
+        height = min(self.chunk_size, self.lines - y)
+        image = pygame.Surface((width * tile_x, height * tile_y))
+        codes = self.level.get_tile_codes((x - BORDER[0], y - BORDER[1], width, height))
+        blitter.blit_all(image, blitter.tile_blits(self.level.tile_directory, codes,
+                                                   self.level.tile_size),
+                         BLIT_MODE == "batched")
+        return image
+
+    def get_chunk(self, i, j):
+        """Returns the chunk in column 'i' and line 'j', rendering it if it
+        is not cached."""
+        key = (i, j)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+        else:
+            chunk = self.render_chunk(i, j)
+            self.chunks[key] = chunk
+            self.memory += chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+        return self.chunks[key]
+
+    def evict(self, keep=()):
+        """Drops least recently used chunks not in 'keep' until the cache
+        fits into the memory budget."""
+        for key in list(self.chunks):
+            if self.memory <= self.memory_budget:
+                break
+            if key not in keep:
+                chunk = self.chunks.pop(key)
+                self.memory -= chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+
+    def visible_chunks(self, position, area):
+        """Returns the keys of all chunks overlapping the rectangle 'area' if
+        the top left corner of the map is drawn at 'position'."""
+        size_x = self.chunk_size * self.level.tile_size[0]
+        size_y = self.chunk_size * self.level.tile_size[1]
+        left = max((area.left - position[0]) // size_x, 0)
+        top = max((area.top - position[1]) // size_y, 0)
+        right = min((area.right - 1 - position[0]) // size_x,
+                    (self.columns - 1) // self.chunk_size)
+        bottom = min((area.bottom - 1 - position[1]) // size_y,
+                     (self.lines - 1) // self.chunk_size)
+        return [(i, j) for j in range(top, bottom + 1) for i in range(left, right + 1)]
+
+    def draw(self, surface, position, area=None):
+        """Draws the part of the map inside the rectangle 'area' of 'surface'
+        (by default the whole surface), with the top left corner of the map
+        at 'position'."""
+        self.position = position
+        if area is None:
+            area = surface.get_rect()
+        area = pygame.Rect(area)
+        keys = self.visible_chunks(position, area)
+        clip = surface.get_clip()
+        surface.set_clip(area.clip(clip))
+        size_x = self.chunk_size * self.level.tile_size[0]
+        size_y = self.chunk_size * self.level.tile_size[1]
+        blitter.blit_all(surface, [(self.get_chunk(i, j),
+                                    (position[0] + i * size_x, position[1] + j * size_y))
+                                   for i, j in keys],
+                         BLIT_MODE == "batched")
+        surface.set_clip(clip)
+        self.evict(keys)
+
+    def clear(self, surface, rect):
+        """Redraws the map inside 'rect' at the position of the last call of
+        'draw'. Can be given to the 'clear' method of sprite groups."""
+        self.draw(surface, self.position, rect)
+
+    def redraw_tile(self, x, y, tile):
+        """Blits 'tile' at ('x', 'y') onto its chunk if that chunk has been
+        rendered already. Other chunks will show it once they are rendered."""
+        i, u = divmod(x + BORDER[0], self.chunk_size)
+        j, v = divmod(y + BORDER[1], self.chunk_size)
+        if (i, j) in self.chunks:
+            self.chunks[(i, j)].blit(tile, (u * self.level.tile_size[0], v * self.level.tile_size[1]))
+
+class FogLayer():
+    """The fog of war 'fog' (a fov.FogOfWar) over 'level' including its
+    border. The fog is kept as a surface with one pixel per tile, which is
+    only changed where the visibility changed and scaled up when drawn."""
+    def __init__(self, level, fog):
+        self.level = level
+        self.fog = fog
+        self.image = pygame.Surface((level.grid.stride, level.grid.lines), pygame.SRCALPHA)
+        self.image.fill(FOG_COLORS[fov.UNEXPLORED])
+        self.position = (0, 0)
+        self.update(fog.visible)
+
+    def update(self, indices):
+        """Updates the fog over the grid tiles 'indices'. Returns the
+        rectangles of the tiles relative to the background."""
+        tile_x, tile_y = self.level.tile_size
+        stride = self.level.grid.stride
+        rects = []
+        for index in indices:
+            v, u = divmod(index, stride)
+            self.image.set_at((u, v), FOG_COLORS[self.fog.visibility(index)])
+            rects.append(pygame.Rect(u * tile_x, v * tile_y, tile_x, tile_y))
+        return rects
+
+    def draw(self, surface, position, area=None):
+        """Draws the fog onto 'surface' with the top left corner of the
+        border at 'position'. Only the tiles overlapping 'area' (a rectangle
+        on 'surface') are drawn, the whole surface by default."""
         self.position = position
+        tile_x, tile_y = self.level.tile_size
+        area = surface.get_rect() if area is None else surface.get_rect().clip(area)
+        u0 = max((area.left - position[0]) // tile_x, 0)
+        v0 = max((area.top - position[1]) // tile_y, 0)
+        u1 = min((area.right - position[0] - 1) // tile_x + 1, self.image.get_width())
+        v1 = min((area.bottom - position[1] - 1) // tile_y + 1, self.image.get_height())
+        if u0 >= u1 or v0 >= v1 or not area:
+            return
+        fog = self.image.subsurface((u0, v0, u1 - u0, v1 - v0))
+        fog = pygame.transform.scale(fog, ((u1 - u0) * tile_x, (v1 - v0) * tile_y))
+        clip = surface.get_clip()
+        surface.set_clip(area)
+        surface.blit(fog, (position[0] + u0 * tile_x, position[1] + v0 * tile_y))
+        surface.set_clip(clip)
+
+class LevelPyramid():
+    """Zoomed out views of 'level' including its border: 'minimap' with one
+    pixel per tile in the color of its type and 'images', the background at
+    1/scale of its size for each of 'scales'. They are made from the tile
+    codes with shrunk tiles instead of by shrinking the whole background,
+    and the level updates them when tiles change. The game only needs the
+    minimap, the backgrounds are rendered when asked for."""
+    def __init__(self, level, scales=()):
+        self.level = level
+        tiles = level.grid
+        # The types of the tiles are the palette indices of the minimap
+        self.palette = [(255, 0, 255)] * 256
+        for char, color in level.colors.items():
+            self.palette[ord(char)] = tuple(pygame.Color(color))[:3]
+        minimap = pygame.image.frombuffer(bytes(tiles.types), (tiles.stride, tiles.lines), "P")
+        minimap.set_palette(self.palette)
+        self.minimap = minimap.copy()
+
+        self.images = {}
+        self.tile_directories = {}
+        if scales:
+            codes = level.get_tile_codes()
+            for scale in scales:
+                self.render_scale(scale, codes)
+
+    def render_scale(self, scale, codes):
+        """Renders the background at 1/'scale' of its size from the tile
+        codes 'codes' of the level."""
+        tiles = self.level.grid
+        tile_directory = load_scaled_tile_set(self.level.tile_set, self.level.legend, scale)
+        size = next(iter(tile_directory.values())).get_size()
+        image = pygame.Surface((tiles.stride * size[0], tiles.lines * size[1]))
+        blitter.blit_all(image, blitter.tile_blits(tile_directory, codes, size),
+                         BLIT_MODE == "batched")
+        self.images[scale] = image
+        self.tile_directories[scale] = tile_directory
+
+    def update_tile(self, x, y, code):
+        """Draws the tile with code 'code' at ('x', 'y') again."""
+        u = x + self.level.grid.border_x
+        v = y + self.level.grid.border_y
+        self.minimap.set_at((u, v), self.palette[ord(self.level.get_tile_type(x, y))])
+        for scale, image in self.images.items():
+            tile = self.tile_directories[scale][code]
+            image.blit(tile, (u * tile.get_width(), v * tile.get_height()))
+
+class MinimapLayer():
+    """The part of the minimap of 'level' the player has explored, as told
+    by 'fog' (a fov.FogOfWar), with a marker on the player's tile. Tiles out
+    of sight are dimmed. Only the pixels of tiles whose visibility changed
+    are updated, and at most 'size' pixels around the marker are shown."""
+    def __init__(self, level, fog, size=MINIMAP_SIZE):
+        self.level = level
+        self.fog = fog
+        self.pyramid = level.render_pyramid()
+        self.image = pygame.Surface(self.pyramid.minimap.get_size(), pygame.SRCALPHA)
+        self.window = pygame.Rect((0, 0), size).clip(self.image.get_rect())
+        self.marker = None
+        self.changed = True
+        self.update(fog.visible)
+
+    def update(self, indices):
+        """Updates the pixels of the grid tiles 'indices'."""
+        stride = self.level.grid.stride
+        minimap = self.pyramid.minimap
+        for index in indices:
+            v, u = divmod(index, stride)
+            visibility = self.fog.visibility(index)
+            if index == self.marker:
+                color = MINIMAP_MARKER
+            elif visibility == fov.UNEXPLORED:
+                color = (0, 0, 0, 0)
+            else:
+                color = minimap.get_at((u, v))
+                if visibility == fov.EXPLORED:
+                    color = (color.r // 2, color.g // 2, color.b // 2)
+            self.image.set_at((u, v), color)
+            self.changed = True
+
+    @property
+    def size(self):
+        """The size of the part of the minimap shown."""
+        return self.window.size
+
+    def move_marker(self, x, y):
+        """Puts the marker onto the tile at ('x', 'y') and centers the part
+        shown around it."""
+        old = self.marker
+        self.marker = self.level.grid.index(x, y)
+        self.update([self.marker] if old is None else [old, self.marker])
+        tiles = self.level.grid
+        self.window.center = (x + tiles.border_x, y + tiles.border_y)
+        self.window.clamp_ip(self.image.get_rect())
+
+    def draw(self, surface, position, area=None):
+        """Draws the shown part of the minimap onto 'surface' at 'position'.
+        Only the part inside the rectangle 'area' of 'surface' is drawn, all
+        of it by default. Returns the rectangle drawn to."""
+        self.changed = False
+        rect = pygame.Rect(position, self.window.size)
+        if area is not None:
+            rect = rect.clip(area)
+        if rect:
+            source = rect.move(self.window.left - position[0], self.window.top - position[1])
+            surface.blit(self.image, rect, source)
+        return rect
+
+class AnimatedLayer():
+    """The animated tiles of 'level' including its border, e.g. sparkling
+    water. The tiles are indexed in square buckets of 'CHUNK_SIZE' tiles at
+    render time. Each frame of an animated tile is shown for 'rate' ticks of
+    the animation clock, with a phase depending on the tile, so only a few
+    tiles change with each tick and only those are drawn again. 'codes' are
+    the tile codes of the whole level, if already known."""
+    def __init__(self, level, rate=WATER_RATE, clock=animation.CLOCK, codes=None):
+        self.level = level
         self.rate = rate
-        self.animation = self.stand_animation()
+        self.clock = clock
+        self.buckets = {}
+        self.position = (0, 0)
+        self.frames = {}
+        tiles = level.grid
+        for char in ANIMATED_CODES:
+            index = tiles.types.find(ord(char))
+            if index >= 0 and codes is None:
+                # Classify the whole level at once rather than tile by tile
+                codes = level.get_tile_codes()
+            while index >= 0:
+                v, u = divmod(index, tiles.stride)
+                x, y = u - tiles.border_x, v - tiles.border_y
+                key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+                self.buckets.setdefault(key, {})[(x, y)] = self.entry(
+                    x, y, codes[y + BORDER[1]][x + BORDER[0]])
+                index = tiles.types.find(ord(char), index + 1)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def entry(self, x, y, code):
+        """Returns the frames and the phase of the animated tile with code
+        'code' at ('x', 'y'). Tiles with the same code share the frames."""
+        frames = self.frames.get(code)
+        if frames is None:
+            tiles = self.level.tile_directory
+            frames = tuple(tiles[frame + code[2:]] for frame in ANIMATED_CODES[code[0]])
+            self.frames[code] = frames
+        phase = (7 * x + 13 * y + self.level.get_tile_variation(x, y)) % (self.rate * len(frames))
+        return frames, phase
 
-    def stand_animation(self):
-        while True:
-            for frame in self.frames:
-                for i in range(self.rate):
-                    self.image = frame
-                    yield
+    def update_tile(self, x, y, code):
+        """Puts the tile with code 'code' at ('x', 'y') into the index or
+        removes it if it is not animated."""
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        bucket = self.buckets.setdefault(key, {})
+        bucket.pop((x, y), None)
+        if code[0] in ANIMATED_CODES:
+            bucket[(x, y)] = self.entry(x, y, code)
+        if not bucket:
+            del self.buckets[key]
+
+    def tiles_in(self, position, area):
+        """Yields the position, frames and phase of all animated tiles
+        overlapping the rectangle 'area' if the top left corner of the
+        border is drawn at 'position'."""
+        tile_x, tile_y = self.level.tile_size
+        x0 = (area.left - position[0]) // tile_x - BORDER[0]
+        y0 = (area.top - position[1]) // tile_y - BORDER[1]
+        x1 = (area.right - 1 - position[0]) // tile_x - BORDER[0]
+        y1 = (area.bottom - 1 - position[1]) // tile_y - BORDER[1]
+        for j in range(y0 // CHUNK_SIZE, y1 // CHUNK_SIZE + 1):
+            for i in range(x0 // CHUNK_SIZE, x1 // CHUNK_SIZE + 1):
+                for (x, y), (frames, phase) in self.buckets.get((i, j), {}).items():
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        yield x, y, frames, phase
+
+    def tile_rect(self, x, y):
+        """Returns the rectangle of the tile at ('x', 'y') on the surface
+        drawn to last."""
+        tile_x, tile_y = self.level.tile_size
+        return pygame.Rect(self.position[0] + (x + BORDER[0]) * tile_x,
+                           self.position[1] + (y + BORDER[1]) * tile_y, tile_x, tile_y)
+
+    def draw(self, surface, position, area=None):
+        """Draws the current frames of the animated tiles inside the
+        rectangle 'area' of 'surface' (by default the whole surface), with
+        the top left corner of the border at 'position'."""
+        self.position = position
+        area = surface.get_rect() if area is None else surface.get_rect().clip(area)
+        if not area:
+            return
+        tick = self.clock.tick
+        blits = [(frames[(tick + phase) // self.rate % len(frames)], self.tile_rect(x, y))
+                 for x, y, frames, phase in self.tiles_in(position, area)]
+        clip = surface.get_clip()
+        surface.set_clip(area)
+        blitter.blit_all(surface, blits, BLIT_MODE == "batched")
+        surface.set_clip(clip)
+
+    def changed(self, surface, since):
+        """Returns the rectangles of the animated tiles on 'surface' whose
+        frame changed between the ticks 'since' and the current one."""
+        tick = self.clock.tick
+        if tick == since:
+            return []
+        rate = self.rate
+        return [self.tile_rect(x, y)
+                for x, y, frames, phase in self.tiles_in(self.position, surface.get_rect())
+                if (tick + phase) // rate != (since + phase) // rate]
+
+class Motion():
+    """The position at which 'entity' is shown, which follows the entity
+    from tile to tile in 'frames' logic frames instead of jumping. Entities
+    moving further than one tile jump. 'x' and 'y' are the position shown
+    in the frame being drawn, interpolated between the last two logic
+    frames."""
+    def __init__(self, entity, frames=MOVE_FRAMES):
+        self.entity = entity
+        self.speed = 1 / max(frames, 1)
+        self.x, self.y = entity.x, entity.y
+        self.current = self.previous = (entity.x, entity.y)
 
     def update(self):
-        return next(self.animation)
+        """Moves the position shown towards the entity by one logic
+        frame."""
+        x, y = self.current
+        dx = self.entity.x - x
+        dy = self.entity.y - y
+        self.previous = self.current
+        if abs(dx) > 1 or abs(dy) > 1:
+            self.previous = self.current = (self.entity.x, self.entity.y)
+            return
+        step = self.speed
+        self.current = (x + max(-step, min(step, dx)), y + max(-step, min(step, dy)))
+
+    def interpolate(self, alpha):
+        """Sets the position shown to the point 'alpha' (from 0 to 1) of the
+        way from the last but one to the last logic frame."""
+        (x0, y0), (x1, y1) = self.previous, self.current
+        self.x = x0 + (x1 - x0) * alpha
+        self.y = y0 + (y1 - y0) * alpha
+
+def avatar_legend_file(player_file):
+    """Returns the legend of the avatar of the player 'player_file'."""
+    avatar_name = read_config(player_file)["info"]["avatar"]
+    return FOLDERS["AVATARS"] + "/{0}.leg".format(avatar_name)
 
-    def update_position(self, x, y):
-        self.rect = pygame.Rect(x, y, 24, 24)
+def avatar_sheet(avatar_legend):
+    """Returns the image file and the colorkey of the avatar legend
+    'avatar_legend'."""
+    tile_set_name = avatar_legend["info"]["tile_set"]
+    file_name = FOLDERS["AVATARS"] + "/{0}.png".format(tile_set_name)
+    colorkey = [int(avatar_legend["info"]["colorkey_" + i]) for i in "rgb"]
+    return file_name, colorkey
 
 class Player():
+    blocking = True
+
     def __init__(self, level):
         self.level = level
         self.x, self.y = tuple(level.player_position)
@@ -301,13 +1106,9 @@ class Player():
         #return (116 + (x - self.x)*24, 84 + (y - self.y)*24)
 
     def load_file(self, filename):
-        parser = configparser.ConfigParser()
-        parser.read(filename)
-        self.avatar_legend = configparser.ConfigParser()
-        avatar_name = parser.get("info", "avatar")
-        avatar_file_name = FOLDERS["AVATARS"] + "/{0}.leg".format(avatar_name)
+        avatar_file_name = avatar_legend_file(filename)
         print(avatar_file_name)
-        self.avatar_legend.read(avatar_file_name)
+        self.avatar_legend = read_config(avatar_file_name)
         #self.tile_position = {0:[parser["tiles"].getint(i) for i in "xy"]}
         #self.tile_set_name = parser.get("tiles", "tile_set")
 
@@ -315,59 +1116,446 @@ class Player():
         #file_name = FOLDERS["AVATARS"] + "/{0}.png".format(self.tile_set_name)
         #self.image = load_tile_file(file_name, self.tile_position, (24, 24), (0,128,128))[0]
         #return self.image
-        tile_set_name = self.avatar_legend.get("info", "tile_set")
-        file_name = FOLDERS["AVATARS"] + "/{0}.png".format(tile_set_name)
-        n = self.avatar_legend["info"].getint("idle_frames_number")
-        position_dictionary = {i:[self.avatar_legend["idle"].getint(str(i) + j) for j in "xy"]
-                for i in range(n)}
-        size = [self.avatar_legend["info"].getint("size_" + i) for i in "xy"]
-        colorkey = [self.avatar_legend["info"].getint("colorkey_" + i) for i in "rgb"]
-        frame_dictionary = load_tile_file(file_name, position_dictionary, size, colorkey)
-        frames = [frame_dictionary[i] for i in range(n)]
-        rate = self.avatar_legend["info"].getint("idle_framerate")
-        self.idle_sprite = MySprite((128-12, 96-12), frames, rate)
+        file_name, colorkey = avatar_sheet(self.avatar_legend)
+        n = int(self.avatar_legend["info"]["idle_frames_number"])
+        positions = [[int(self.avatar_legend["idle"][str(i) + j]) for j in "xy"]
+                     for i in range(n)]
+        size = [int(self.avatar_legend["info"]["size_" + i]) for i in "xy"]
+        rate = int(self.avatar_legend["info"]["idle_framerate"])
+        idle = load_animation(file_name, positions, size, colorkey, rate)
+        self.idle_sprite = animation.AnimatedSprite(idle, (128-12, 96-12))
         return self.idle_sprite
 
-    def walk(self, direction):
-        if direction.lower() == "w":
-            #self.y -= 1
-            new_x = self.x
-            new_y = self.y - 1
-        elif direction.lower() == "a":
-            #self.x -= 1
-            new_x = self.x - 1
-            new_y = self.y
-        elif direction.lower() == "s":
-            #self.y += 1
-            new_x = self.x
-            new_y = self.y + 1
-        elif direction.lower() == "d":
-            #self.x += 1
-            new_x = self.x + 1
-            new_y = self.y
-        else:
-            print("Attempting to walk in invalid direction. Standing still!")
-            new_x = self.x
-            new_y = self.y
-        if self.level.get_tile_type(new_x, new_y) == ".":
-            self.x = new_x
-            self.y = new_y
-        print(self.x, self.y)
-
 class Stairs():
+    sheet = "tile_sets/items_and_traps.png"
+    colorkey = (0, 128, 128)
+
     def __init__(self, level):
         self.level = level
         self.x, self.y = level.stairs_position
 
     def render(self):
-        file_name = "tile_sets/items_and_traps.png"
-        position_dictionary = {0:(13, 387)}
         size = (24, 24)
-        colorkey = (0, 128, 128)
-        image = load_tile_file(file_name, position_dictionary, size, colorkey)[0]
-        self.sprite = MySprite((0,0), [image])
+        steps = load_animation(self.sheet, [(13, 387)], size, self.colorkey)
+        self.sprite = animation.AnimatedSprite(steps)
         return self.sprite
         
+def prepare_floor(seed, size, tile_set):
+    """Generates the dungeon floor with seed 'seed' and size 'size' as level
+    with the tile set 'tile_set'. Returns the level, the result of
+    simulation.prepare_world for it and its tile codes. Meant to be run in a
+    worker thread, so it only touches data: Blitting from the tile set while
+    the main thread draws with it is not safe, so the level is rendered on
+    the main thread."""
+    floor = dungeon.generate_floor(size[0], size[1], seed)
+    level = Level()
+    level.load_data(floor.map, floor.default_tile, floor.player_position,
+                    floor.stairs_position, tile_set)
+    return level, simulation.prepare_world(level), level.get_tile_codes()
+
+def preload(asset_loader, player_file, tile_set):
+    """Submits the assets of the first frame of a game with the player
+    'player_file' and the tile set 'tile_set' to the loader.AssetLoader
+    'asset_loader'. Legends are read and images decoded in its worker
+    threads, images are converted on the main thread. The assets are put
+    into ASSET_CACHE, where the game finds them."""
+    def finish_sheet(loaded):
+        filename, colorkey, image = loaded
+        return ASSET_CACHE.get(sheet_key(filename, colorkey),
+                               lambda: convert_sheet(image, colorkey))
+
+    def read_avatar():
+        file_name, colorkey = avatar_sheet(read_config(avatar_legend_file(player_file)))
+        return file_name, colorkey, pygame.image.load(file_name)
+
+    def read_tile_set():
+        legend = load_legend(tile_set)
+        baked = atlas.read_atlas(atlas_file_name(tile_set), tile_set_sources(tile_set),
+                                 legend_hash(legend))
+        # Without an up to date atlas the tiles are composed from the sheet
+        image = None
+        if baked is None:
+            image = pygame.image.load(FOLDERS["MAPS"] + "/{0}.png".format(tile_set))
+        return legend, baked, image
+
+    def finish_tile_set(loaded):
+        legend, baked, image = loaded
+        if baked is None:
+            colorkey = [int(legend["info"]["colorkey_" + i]) for i in "rgb"]
+            finish_sheet((FOLDERS["MAPS"] + "/{0}.png".format(tile_set), colorkey, image))
+            return load_tile_set(tile_set, legend)
+        return ASSET_CACHE.get(("tile_set", tile_set, legend_key(legend)),
+                               lambda: atlas.atlas_tiles(*baked))
+
+    asset_loader.submit("tile set " + tile_set, read_tile_set, finish_tile_set)
+    asset_loader.submit("avatar", read_avatar, finish_sheet)
+    asset_loader.submit("stairs", lambda: (Stairs.sheet, Stairs.colorkey,
+                                           pygame.image.load(Stairs.sheet)), finish_sheet)
+    asset_loader.submit("font", lambda: pygame.image.load(font.sheet_file(FONT_LEGEND)),
+                        lambda image: load_font(FONT_LEGEND, image))
+
+def draw_loading_screen(screen, progress):
+    """Draws a bar filled to 'progress' (from 0 to 1) on 'screen'."""
+    screen.fill((0, 0, 0))
+    bar = pygame.Rect(0, 0, SCREEN_SIZE[0] // 2, 8)
+    bar.center = screen.get_rect().center
+    pygame.draw.rect(screen, (128, 128, 128), bar, 1)
+    pygame.draw.rect(screen, (248, 248, 248),
+                     (bar.x + 2, bar.y + 2, round((bar.width - 4) * progress), bar.height - 4))
+    pygame.display.flip()
+
+class Game():
+    """A running game on the level 'level_file' with the player from
+    'player_file'. The screen has to be set before. Taking the stairs leads
+    to 'floors' generated dungeon floors, the next of which is prepared in
+    the background. The rules are left to a simulation.Simulation, the game
+    only turns key presses into its actions and draws its events. If
+    'tile_set' is given, it is used instead of the tile set of the level."""
+    def __init__(self, level_file, player_file=PLAYER_FILE,
+                 floors=DUNGEON_FLOORS, seed=DUNGEON_SEED, tile_set=None):
+        # Initialize level
+        level = Level()
+        level.load_file(level_file, tile_set)
+
+        # Initialize player
+        self.player = Player(level)
+        self.player.load_file(player_file)
+        self.player_file = player_file
+        self.avatar = self.player.render()
+        self.players = animation.AnimatedGroup(batched=BLIT_MODE == "batched")
+        self.players.add(self.avatar)
+
+        # Initialize screen
+        self.screen = pygame.display.get_surface()
+        self.screen.fill((128,128,128))
+
+        # Initialize simulation
+        self.floors = floors
+        self.floor = 0
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.simulation = simulation.Simulation(level, self.seed, floors, 0, self.player,
+                                                self.load_floor, DUNGEON_SIZE)
+        self.simulation.observers.append(self.observe)
+
+        # Draw on screen
+        self.stairs_and_traps = animation.AnimatedGroup(batched=BLIT_MODE == "batched")
+        self.font = load_font(FONT_LEGEND)
+        self.log = font.MessageLog(self.font, SCREEN_SIZE[0] - 4, LOG_LINES)
+        self.log_position = (2, SCREEN_SIZE[1] - 2 - self.log.image.get_height())
+        self.log.add("Welcome! Find the stairs and press K.")
+        self.show_minimap = MINIMAP_ENABLED
+        self.set_level(level, level.render_chunked())
+
+        # Prepare next floor
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.next_level = None
+        self.next_codes = None
+        self.prefetch()
+
+        self.running = True
+        self.frames = 0
+        # When loading started, to report the time to the first frame
+        self.started = time.perf_counter()
+        # A recording.Recorder or recording.Replayer
+        self.recording = None
+        self.full_redraws = 0
+        self.pixels_total = 0
+        self.frames_drawn = 0
+
+        # Initialize profiler
+        self.profiler = profiler.FrameProfiler(FRAME_PHASES, PROFILER_CAPACITY, PROFILER_ENABLED)
+        self.overlay = None
+        self.overlay_rect = pygame.Rect(0, 0, 0, 0)
+        self.overlay_font = None
+        if PROFILER_ENABLED and PROFILER_OVERLAY:
+            self.overlay_font = pygame.font.Font(None, 14)
+
+    def set_level(self, level, background, codes=None):
+        """Shows the level 'level' of the simulation with the background
+        'background'. 'codes' are the tile codes of the level, if already
+        known."""
+        self.level = level
+        self.player.level = level
+        # Where the player and the other entities are shown. The camera
+        # follows the player.
+        self.motions = {}
+        self.view = Motion(self.player)
+        self.coordinates = transform(self.view, level.tile_size)
+
+        # Initialize stairs
+        self.stairs = Stairs(level)
+        self.steps = self.stairs.render()
+        self.simulation.stairs.sprite = self.steps
+        self.stairs_and_traps.empty()
+
+        self.background = background
+        self.water = level.render_animated(codes=codes)
+        self.fog = FogLayer(level, self.simulation.fog)
+        self.minimap = MinimapLayer(level, self.simulation.fog)
+        self.minimap.move_marker(self.player.x, self.player.y)
+        self.minimap_position = (SCREEN_SIZE[0] - 2 - self.minimap.window.width, 2)
+        self.camera = None
+        self.drawn_tick = animation.CLOCK.tick
+        self.edited = []
+
+    def prefetch(self):
+        """Starts preparing the next floor in the background."""
+        if self.floor < self.floors:
+            seed = dungeon.floor_seed(self.seed, self.floor + 1)
+            self.next_level = self.executor.submit(prepare_floor, seed, DUNGEON_SIZE,
+                                                   self.level.tile_set)
+        else:
+            self.next_level = None
+
+    def load_floor(self, seed, size):
+        """Returns the prepared next floor to the simulation. It was
+        generated with the same seed and size."""
+        level, prepared, self.next_codes = self.next_level.result()
+        return level, prepared
+
+    def observe(self, simulation, events):
+        """Reacts to the 'events' of a turn of 'simulation'."""
+        for event in events:
+            if event[0] == "floor":
+                level = simulation.world
+                self.set_level(level, level.render_chunked(), self.next_codes)
+                self.next_codes = None
+                self.floor = event[1]
+                print("Floor {0}".format(self.floor))
+                self.log.add("Floor {0} of {1}".format(self.floor, self.floors))
+                self.prefetch()
+            elif event[0] == "seen":
+                self.edited += self.fog.update(event[1])
+                self.minimap.update(event[1])
+            elif event[0] == "caught":
+                self.log.add("A monster caught you!", (248, 80, 80))
+            elif event[0] == "finished":
+                self.running = False
+            elif event[0] == "moved" and event[1] is self.player:
+                print(self.player.x, self.player.y)
+                self.minimap.move_marker(self.player.x, self.player.y)
+        if (self.recording is not None
+                and simulation.turn % self.recording.checkpoint_interval == 0):
+            self.recording.checkpoint(self.frames, simulation.state_hash())
+
+    def set_tile(self, x, y, char):
+        """Changes the tile at ('x', 'y') of the level to 'char'. Only the
+        changed tiles are drawn again with the next frame."""
+        self.edited += self.level.set_tile(x, y, char)
+        changed = self.simulation.update_tile(x, y)
+        self.edited += self.fog.update(changed)
+        self.minimap.update(set(changed) | {self.level.grid.index(x, y)})
+
+    def handle_event(self, event):
+        """Reacts to the PyGame event 'event'."""
+        if event.type == pygame.QUIT:
+            self.running = False
+        elif event.type == pygame.KEYDOWN:
+            key = event.key
+            if key == pygame.K_x:
+                self.running = False
+            elif key == pygame.K_w:
+                self.simulation.step(("walk", "w"))
+            elif key == pygame.K_a:
+                self.simulation.step(("walk", "a"))
+            elif key == pygame.K_s:
+                self.simulation.step(("walk", "s"))
+            elif key == pygame.K_d:
+                self.simulation.step(("walk", "d"))
+            elif key == pygame.K_k:
+                self.simulation.step(("stairs",))
+            elif key == pygame.K_m:
+                self.show_minimap = not self.show_minimap
+                self.camera = None
+
+    def step(self, events):
+        """Advances the game by one logic frame in which the PyGame events
+        'events' are handled."""
+        if self.recording is not None:
+            self.recording.record(self.frames, events)
+        for event in events:
+            self.handle_event(event)
+        self.profiler.mark("events")
+        animation.CLOCK.advance()
+        self.view.update()
+        for motion in self.motions.values():
+            motion.update()
+        self.frames += 1
+        self.profiler.mark("update")
+
+    def draw(self, alpha=1.0):
+        """Draws the current frame and updates the display, with entities
+        shown at 'alpha' of the way between the last two logic frames.
+        Returns the number of pixels pushed to the display."""
+        screen = self.screen
+        mark = self.profiler.mark
+        #screen.blit(avatar, (128-12, 96-12))
+        #steps.position = coordinates(*stairs.level.stairs_position)
+        self.view.interpolate(alpha)
+        self.cull_sprites(alpha)
+        origin = self.coordinates(-BORDER[0], -BORDER[1])
+        if RENDER_MODE == "full" or self.camera != origin:
+            # Camera moved: Redraw everything
+            self.camera = origin
+            #screen_position = (-24*(player.x + BORDER[0])+128-12, -24*(player.y + BORDER[1])+96-12)
+            self.background.draw(screen, self.coordinates(-BORDER[0], -BORDER[1]))
+            self.water.draw(screen, self.coordinates(-BORDER[0], -BORDER[1]))
+            self.fog.draw(screen, self.coordinates(-BORDER[0], -BORDER[1]))
+            mark("background")
+            self.stairs_and_traps.draw(screen)
+            self.players.draw(screen)
+            for layer, position in self.hud():
+                layer.draw(screen, position)
+            self.draw_overlay()
+            mark("draw")
+            pygame.display.flip()
+            mark("present")
+            dirty = [screen.get_rect()]
+            self.full_redraws += 1
+        else:
+            # Camera stood still: Only redraw the sprites, changed tiles and
+            # animated tiles showing their next frame
+            edited = [rect.move(origin) for rect in self.edited]
+            for rect in edited:
+                self.clear(screen, rect)
+            if self.overlay_rect:
+                self.clear(screen, self.overlay_rect)
+            hud = [(layer, position, pygame.Rect(position, layer.size))
+                   for layer, position in self.hud()]
+            for layer, position, rect in hud:
+                if layer.changed:
+                    self.clear(screen, rect)
+                    edited.append(rect)
+            self.players.clear(screen, self.clear)
+            self.stairs_and_traps.clear(screen, self.clear)
+            animated = self.water.changed(screen, self.drawn_tick)
+            for rect in animated:
+                self.clear(screen, rect)
+            mark("clear")
+            dirty = self.stairs_and_traps.draw(screen) + self.players.draw(screen)
+            dirty += edited + animated
+            # The log and the minimap are drawn over everything else, so
+            # they are drawn again wherever something below was drawn
+            for rect in dirty:
+                for layer, position, layer_rect in hud:
+                    if rect.colliderect(layer_rect):
+                        layer.draw(screen, position, rect)
+            dirty += self.draw_overlay()
+            mark("draw")
+            pygame.display.update(dirty)
+            mark("present")
+        self.edited = []
+        self.drawn_tick = animation.CLOCK.tick
+        pixels = count_pixels(dirty, screen.get_rect())
+        self.pixels_total += pixels
+        self.frames_drawn += 1
+        return pixels
+
+    def hud(self):
+        """Returns the list of the layers drawn over the level, e.g. the
+        message log, with their positions on the screen."""
+        hud = [(self.log, self.log_position)]
+        if self.show_minimap:
+            hud.append((self.minimap, self.minimap_position))
+        return hud
+
+    def clear(self, surface, rect):
+        """Redraws the background, the animated tiles and the fog inside
+        'rect'. Can be given to the 'clear' method of sprite groups."""
+        self.background.clear(surface, rect)
+        self.water.draw(surface, self.water.position, rect)
+        self.fog.draw(surface, self.fog.position, rect)
+
+    def cull_sprites(self, alpha=1.0):
+        """Puts the sprites of the entities on the screen (except for the
+        player) into 'stairs_and_traps' at the positions where they are
+        shown, 'alpha' of the way between the last two logic frames. Sprites
+        leaving the screen are removed."""
+        player = self.player
+        # The camera and the entities may still be on their way from the
+        # last tile
+        reach_x = SCREEN_SIZE[0] // self.level.tile_size[0] // 2 + 2
+        reach_y = SCREEN_SIZE[1] // self.level.tile_size[1] // 2 + 2
+        visible = set()
+        for entity in self.level.entities.in_rect(player.x - reach_x, player.y - reach_y,
+                                                  player.x + reach_x + 1, player.y + reach_y + 1):
+            sprite = getattr(entity, "sprite", None)
+            if (sprite is not None and entity is not player
+                    and self.simulation.fog.is_explored(
+                        self.level.grid.index(entity.x, entity.y))):
+                motion = self.motions.get(entity)
+                if motion is None:
+                    motion = self.motions[entity] = Motion(entity)
+                motion.interpolate(alpha)
+                sprite.update_position(*self.coordinates(motion.x, motion.y))
+                visible.add(sprite)
+        group = self.stairs_and_traps
+        group.remove([sprite for sprite in group if sprite not in visible])
+        group.add(visible)
+
+    def draw_overlay(self):
+        """Draws the frame time percentiles of the profiler onto the screen
+        if the overlay is enabled. Returns the rectangles drawn to."""
+        if not (PROFILER_ENABLED and PROFILER_OVERLAY):
+            return []
+        if self.overlay is None or self.profiler.frames % 12 == 0:
+            lines = [self.overlay_font.render(line, False, (255, 255, 255), (0, 0, 0))
+                     for line in self.profiler.overlay_lines()]
+            self.overlay = pygame.Surface((max(line.get_width() for line in lines),
+                                           sum(line.get_height() for line in lines)))
+            y = 0
+            for line in lines:
+                self.overlay.blit(line, (0, y))
+                y += line.get_height()
+        dirty = [self.overlay_rect.union(self.overlay.get_rect())]
+        self.overlay_rect = self.screen.blit(self.overlay, (0, 0))
+        return dirty
+
+    def frame(self, events):
+        """Handles the PyGame events 'events' in one logic frame and draws
+        it."""
+        self.profiler.start_frame()
+        self.step(events)
+        pixels = self.draw()
+        self.profiler.end_frame()
+        return pixels
+
+    def run(self):
+        """Runs the game with LOGIC_RATE logic frames per second until it is
+        quit. Frames are drawn as often as possible up to MAX_FPS per second
+        (no limit if 0). If drawing falls behind, frames are skipped but
+        logic frames are not."""
+        clock = pygame.time.Clock()
+        scheduler = timing.FrameScheduler(LOGIC_RATE, MAX_FRAME_SKIP)
+        events = []
+        while self.running:
+            self.profiler.start_frame()
+            # Events are handled with the next logic frame
+            events += pygame.event.get()
+            for i in range(scheduler.advance()):
+                self.step(events)
+                events = []
+                if not self.running:
+                    break
+            self.draw(scheduler.alpha)
+            scheduler.drawn_frame()
+            if scheduler.drawn == 1:
+                print("First frame after {0:.1f} ms.".format(
+                    (time.perf_counter() - self.started) * 1000))
+            self.profiler.end_frame()
+            clock.tick(MAX_FPS)
+        self.executor.shutdown()
+
+        print("Pushed {0:.0f} pixels per frame on average ({1} frames, {2} full redraws).".format(
+            self.pixels_total / max(self.frames_drawn, 1),
+            self.frames_drawn, self.full_redraws))
+        print("Asset cache: {0}".format(ASSET_CACHE.statistics()))
+        print("Frame pacing: {0}".format(scheduler.statistics()))
+        if PROFILER_ENABLED:
+            print("Frame times in ms: {0}".format(self.profiler.percentiles()["frame"]))
+            if PROFILER_OUTPUT:
+                self.profiler.save(PROFILER_OUTPUT)
+
 def main():
     # Initialize PyGame
     #print("Initializing PyGame...")
@@ -379,75 +1567,49 @@ def main():
 
     # Get user input
     level_file = ask_for_file(FOLDERS["LEVELS"],".ini","Which level do you want to display?")
+    tile_set = level_tile_set(level_file)
     print("User input complete!")
 
-    # Initialize level
-    level = Level()
-    level.load_file(level_file)
-
-    # Initialize player
-    player = Player(level)
-    player.load_file("players/test01.ini")
-    coordinates = transform(player, level.tile_size)
-
-    # Initialize stairs
-    stairs = Stairs(level)
+    # Load the assets in the background while showing the progress
+    started = time.perf_counter()
+    asset_loader = loader.AssetLoader(LOADER_WORKERS)
+    preload(asset_loader, PLAYER_FILE, tile_set)
 
     # Initialize screen
     screen = pygame.display.set_mode(SCREEN_SIZE)
+    asset_loader.callbacks.append(
+        lambda done, total, name: draw_loading_screen(screen, done / total))
+    asset_loader.wait(callback=pygame.event.pump)
+    asset_loader.shutdown()
+    print("\n".join(asset_loader.report()))
+    # Write the files compiled while loading to the config cache at once
+    save_config()
     #screen = pygame.display.set_mode((1000,700))
     #screen = pygame.display.set_mode(level.dimensions)
-    screen.fill((128,128,128))
-
-    # Draw on screen
-    background = level.render()
-    avatar = player.render()
-    steps = stairs.render()
-    players = pygame.sprite.RenderUpdates()
-    players.add(avatar)
-    stairs_and_traps = pygame.sprite.RenderUpdates()
-    stairs_and_traps.add(steps)
 
     #pygame.mixer.music.load("sounds/031-cave-and-side-path.mp3")
     #pygame.mixer.music.play(-1)
 
-    # Running...
-    running = True
-    clock = pygame.time.Clock()
-    while running:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            elif event.type == pygame.KEYDOWN:
-                key = event.key
-                if key == pygame.K_x:
-                    running = False
-                elif key == pygame.K_w:
-                    player.walk("w")
-                elif key == pygame.K_a:
-                    player.walk("a")
-                elif key == pygame.K_s:
-                    player.walk("s")
-                elif key == pygame.K_d:
-                    player.walk("d")
-                elif key == pygame.K_k:
-                    if player.x == stairs.x and player.y == stairs.y:
-                        running = False
-        #screen.blit(avatar, (128-12, 96-12))
-        players.clear(screen, background)
-        players.update()
-        stairs_and_traps.clear(screen, background)
-        #steps.position = coordinates(*stairs.level.stairs_position)
-        steps.update_position(*coordinates(*stairs.level.stairs_position))
-        stairs_and_traps.update()
-        #screen_position = (-24*(player.x + BORDER[0])+128-12, -24*(player.y + BORDER[1])+96-12)
-        screen.blit(background, coordinates(-BORDER[0], -BORDER[1]))
-        dirty1 = stairs_and_traps.draw(screen)
-        dirty2 = players.draw(screen)
-        pygame.display.update(dirty1)
-        pygame.display.update(dirty2)
-        pygame.display.flip()
-        clock.tick(24)
+    # Running... The random module is seeded so the session can be replayed
+    seed = random.getrandbits(32)
+    random.seed(seed)
+    game = Game(level_file, PLAYER_FILE, tile_set=tile_set)
+    game.started = started
+    if RECORDING_ENABLED:
+        os.makedirs(RECORDING_FOLDER, exist_ok=True)
+        filename = os.path.join(RECORDING_FOLDER, time.strftime("%Y%m%d-%H%M%S.rec"))
+        game.recording = recording.Recorder(filename, {"seed":seed,
+                                                       "level":level_file,
+                                                       "tile_set":game.level.tile_set,
+                                                       "player":game.player_file,
+                                                       "floors":game.floors,
+                                                       "dungeon_seed":game.seed,
+                                                      }, CHECKPOINT_INTERVAL)
+    game.run()
+    if game.recording is not None:
+        game.recording.checkpoint(game.frames, game.simulation.state_hash())
+        game.recording.close(game.frames)
+        print("Session recorded to {0}".format(filename))
 
     print("Quitting...")
     pygame.quit()
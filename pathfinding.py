@@ -0,0 +1,208 @@
+# pathfinding.py: Shared distance fields for monsters chasing a target
+#
+# Instead of searching a path for every monster, a distance field is computed
+# once per target (e.g. the player or the stairs) by a breadth first search
+# from the target over all walkable tiles. Every monster chasing that target
+# just steps onto the neighbouring tile with the smallest distance. Fields
+# are cached per target and repaired locally when a tile changes between
+# walkable and blocked, so they only need to be computed again when the
+# target moves.
+#
+# Monsters do not block the fields. Instead, tiles occupied by monsters can
+# be avoided when choosing the next step.
+
+import array
+import collections
+import heapq
+
+import grid
+
+UNREACHABLE = 2**31 - 1
+# Directions monsters can move in, like the player
+STEPS = ((0, -1), (-1, 0), (0, 1), (1, 0))
+# Translates tile flags to 1 for walkable and 0 for blocked tiles
+WALKABLE_TABLE = bytes(1 if flags & grid.WALKABLE else 0 for flags in range(256))
+
+class DistanceField():
+    """Distances of all tiles of the walkability bitmap 'walkable' (with
+    'stride' tiles per line) to the tile with index 'target'."""
+    def __init__(self, walkable, stride, target):
+        self.walkable = walkable
+        self.stride = stride
+        self.target = target
+        self.offsets = [dx + dy * stride for dx, dy in STEPS]
+        self.distances = array.array("i", [UNREACHABLE]) * len(walkable)
+        self.compute()
+
+    def compute(self):
+        """Computes the whole field by a breadth first search."""
+        distances = self.distances
+        walkable = self.walkable
+        offsets = self.offsets
+        if not walkable[self.target]:
+            return
+        distances[self.target] = 0
+        queue = collections.deque([self.target])
+        while queue:
+            index = queue.popleft()
+            distance = distances[index] + 1
+            for offset in offsets:
+                other = index + offset
+                if walkable[other] and distances[other] > distance:
+                    distances[other] = distance
+                    queue.append(other)
+
+    def open(self, index):
+        """Repairs the field after the tile 'index' became walkable.
+        Distances can only get shorter, so only the tiles that get closer
+        are visited."""
+        distances = self.distances
+        if index == self.target:
+            distances[index] = 0
+        else:
+            best = min(distances[index + offset] for offset in self.offsets)
+            if best == UNREACHABLE:
+                return
+            distances[index] = best + 1
+        queue = collections.deque([index])
+        while queue:
+            current = queue.popleft()
+            distance = distances[current] + 1
+            for offset in self.offsets:
+                other = current + offset
+                if self.walkable[other] and distances[other] > distance:
+                    distances[other] = distance
+                    queue.append(other)
+
+    def close(self, index):
+        """Repairs the field after the tile 'index' got blocked. Only the
+        tiles whose shortest paths all led through 'index' are computed
+        again."""
+        distances = self.distances
+        offsets = self.offsets
+        if distances[index] == UNREACHABLE:
+            return
+        # Find the tiles depending on 'index' level by level
+        affected = {index}
+        queue = collections.deque([index])
+        while queue:
+            current = queue.popleft()
+            distance = distances[current] + 1
+            for offset in offsets:
+                other = current + offset
+                if other in affected or distances[other] != distance:
+                    continue
+                supported = any(distances[other + step] == distance - 1
+                                and other + step not in affected
+                                and self.walkable[other + step]
+                                for step in offsets)
+                if not supported:
+                    affected.add(other)
+                    queue.append(other)
+        for current in affected:
+            distances[current] = UNREACHABLE
+
+        # Compute them again starting from their unaffected neighbours
+        heap = []
+        for current in affected:
+            if not self.walkable[current]:
+                continue
+            best = min(distances[current + offset] for offset in offsets)
+            if best != UNREACHABLE:
+                distances[current] = best + 1
+                heap.append((best + 1, current))
+        heapq.heapify(heap)
+        while heap:
+            distance, current = heapq.heappop(heap)
+            if distance > distances[current]:
+                continue
+            for offset in offsets:
+                other = current + offset
+                if self.walkable[other] and distances[other] > distance + 1:
+                    distances[other] = distance + 1
+                    heapq.heappush(heap, (distance + 1, other))
+
+class PathFinder():
+    """Distance fields over the level 'level'. The fields of the last
+    'cache_size' targets are kept."""
+    def __init__(self, level, cache_size=16):
+        tiles = level.grid
+        self.grid = tiles
+        self.stride = tiles.stride
+        self.cache_size = cache_size
+        self.fields = collections.OrderedDict()
+        self.computed = 0
+        # Walkability bitmap of the grid. The outermost ring stays blocked,
+        # so searches never leave the grid.
+        self.walkable = tiles.flags.translate(WALKABLE_TABLE)
+        for x in range(tiles.stride):
+            self.walkable[x] = self.walkable[x + (tiles.lines - 1) * tiles.stride] = 0
+        for y in range(tiles.lines):
+            self.walkable[y * tiles.stride] = self.walkable[(y + 1) * tiles.stride - 1] = 0
+
+    def index(self, x, y):
+        return self.grid.index(x, y)
+
+    def position(self, index):
+        v, u = divmod(index, self.stride)
+        return (u - self.grid.border_x, v - self.grid.border_y)
+
+    def is_walkable(self, x, y):
+        index = self.index(x, y)
+        return index >= 0 and bool(self.walkable[index])
+
+    def set_walkable(self, x, y, walkable):
+        """Opens or blocks the tile at ('x', 'y') and repairs all cached
+        fields. Can be used for obstacles other than walls, too."""
+        index = self.index(x, y)
+        if index < 0 or bool(self.walkable[index]) == bool(walkable):
+            return
+        u, v = x + self.grid.border_x, y + self.grid.border_y
+        if not (0 < u < self.stride - 1 and 0 < v < self.grid.lines - 1):
+            return
+        self.walkable[index] = 1 if walkable else 0
+        for field in self.fields.values():
+            if walkable:
+                field.open(index)
+            else:
+                field.close(index)
+
+    def update_tile(self, x, y):
+        """Reads the walkability of the tile at ('x', 'y') from the level
+        again, e.g. after the tile was changed."""
+        self.set_walkable(x, y, self.grid.get_flags(x, y) & grid.WALKABLE)
+
+    def field(self, target):
+        """Returns the distance field of the tile 'target'."""
+        index = self.index(*target)
+        if index in self.fields:
+            self.fields.move_to_end(index)
+            return self.fields[index]
+        field = DistanceField(self.walkable, self.stride, index)
+        self.computed += 1
+        self.fields[index] = field
+        while len(self.fields) > self.cache_size:
+            self.fields.popitem(last=False)
+        return field
+
+    def distance(self, position, target):
+        """Returns the number of steps from 'position' to 'target' or None
+        if 'target' cannot be reached."""
+        distance = self.field(target).distances[self.index(*position)]
+        return None if distance == UNREACHABLE else distance
+
+    def next_step(self, position, target, occupied=()):
+        """Returns the tile a monster at 'position' should step onto to get
+        closer to 'target', avoiding the tiles in 'occupied'. Returns None if
+        there is no such tile."""
+        distances = self.field(target).distances
+        index = self.index(*position)
+        best = distances[index]
+        step = None
+        for dx, dy in STEPS:
+            other = (position[0] + dx, position[1] + dy)
+            distance = distances[index + dx + dy * self.stride]
+            if distance < best and (other == tuple(target) or other not in occupied):
+                best = distance
+                step = other
+        return step
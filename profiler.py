@@ -0,0 +1,99 @@
+# profiler.py: Timing the phases of each frame of the game loop
+#
+# The times of the last 'capacity' frames are kept in a ring buffer, one row
+# per frame and one column per phase plus the total. While the profiler is
+# disabled, every call returns right away.
+
+import csv
+import json
+import array
+import time
+
+class FrameProfiler():
+    """Times the phases 'phases' of every frame. A frame starts with
+    'start_frame', the end of each phase is marked with 'mark' and the frame
+    ends with 'end_frame'."""
+    def __init__(self, phases, capacity=1024, enabled=True):
+        self.phases = list(phases)
+        self.columns = len(self.phases) + 1
+        self.column = {phase:i for i, phase in enumerate(self.phases)}
+        self.capacity = capacity
+        self.enabled = enabled
+        self.buffer = array.array("q", bytes(8 * capacity * self.columns))
+        self.frames = 0
+        self.row = 0
+        self.start = 0
+        self.last = 0
+
+    def start_frame(self):
+        if not self.enabled:
+            return
+        self.row = (self.frames % self.capacity) * self.columns
+        for i in range(self.row, self.row + self.columns):
+            self.buffer[i] = 0
+        self.start = self.last = time.perf_counter_ns()
+
+    def mark(self, phase):
+        """Adds the time since the last mark (or the start of the frame) to
+        the phase 'phase'."""
+        if not self.enabled:
+            return
+        now = time.perf_counter_ns()
+        self.buffer[self.row + self.column[phase]] += now - self.last
+        self.last = now
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        self.buffer[self.row + self.columns - 1] = time.perf_counter_ns() - self.start
+        self.frames += 1
+
+    def rows(self):
+        """Returns the recorded frames from the oldest to the newest as lists
+        of nanoseconds, one for each phase followed by the total."""
+        count = min(self.frames, self.capacity)
+        first = self.frames - count
+        rows = []
+        for frame in range(first, self.frames):
+            row = (frame % self.capacity) * self.columns
+            rows.append(self.buffer[row:row + self.columns].tolist())
+        return rows
+
+    def percentiles(self, percentiles=(50, 90, 99)):
+        """Returns a dictionary {phase: {percentile: milliseconds}} of the
+        recorded frames. The total frame time is called "frame"."""
+        rows = self.rows()
+        result = {}
+        for i, phase in enumerate(self.phases + ["frame"]):
+            values = sorted(row[i] for row in rows)
+            result[phase] = {}
+            for p in percentiles:
+                if values:
+                    rank = max(1, -(-len(values) * p // 100))
+                    result[phase][p] = values[rank - 1] / 1e6
+                else:
+                    result[phase][p] = 0.0
+        return result
+
+    def save(self, filename):
+        """Writes the recorded frames to 'filename' in nanoseconds, as JSON
+        if the file name ends with ".json" and as CSV otherwise."""
+        header = self.phases + ["frame"]
+        rows = self.rows()
+        with open(filename, "w", newline="") as output_file:
+            if filename.endswith(".json"):
+                json.dump({"unit":"ns",
+                           "phases":header,
+                           "frames":rows,
+                           "percentiles_ms":self.percentiles(),
+                          }, output_file, indent=1)
+            else:
+                writer = csv.writer(output_file)
+                writer.writerow(header)
+                writer.writerows(rows)
+
+    def overlay_lines(self):
+        """Returns lines of text describing the frame time percentiles."""
+        frame = self.percentiles()["frame"]
+        return ["frame ms", "p50 {0:.1f}".format(frame[50]),
+                "p90 {0:.1f}".format(frame[90]), "p99 {0:.1f}".format(frame[99])]
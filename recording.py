@@ -0,0 +1,133 @@
+# recording.py: Recording the input of a game session to replay it
+#
+# A recording starts with the magic bytes b"PMDREPLAY", followed by the
+# length of the header as four byte big endian integer and the header as
+# JSON. The header holds everything needed to start the same game again: the
+# seed of the random module, the level, the tile set, the player and the
+# seed of the dungeon. It is followed by records of 17 bytes each: the kind
+# of the record, the frame and the milliseconds since the start of the
+# session as four byte integers and a value as eight byte integer.
+#
+# Key presses and quitting are recorded with the logic frame (see timing.py)
+# they were handled in. Every 'checkpoint_interval' turns, a hash of the
+# state of the simulation is recorded, so a replay can tell where it went
+# different. Records are written as they come and flushed with every
+# checkpoint, so a recording of a crashed session can still be replayed up
+# to the last checkpoint.
+
+import json
+import time
+import struct
+
+import pygame
+
+MAGIC = b"PMDREPLAY"
+VERSION = 1
+RECORD = struct.Struct(">BIIQ")
+
+# Kinds of records
+KEY_DOWN = 1
+QUIT = 2
+CHECKPOINT = 3
+END = 4
+
+class Recorder():
+    """Records a game session into the file 'filename'. 'header' is a
+    dictionary of what is needed to start the game again."""
+    def __init__(self, filename, header, checkpoint_interval=10):
+        self.checkpoint_interval = checkpoint_interval
+        header = dict(header, version=VERSION, checkpoint_interval=checkpoint_interval)
+        header = json.dumps(header, sort_keys=True).encode("utf-8")
+        self.file = open(filename, "wb")
+        self.file.write(MAGIC + struct.pack(">I", len(header)) + header)
+        self.start = time.perf_counter()
+        self.records = 0
+
+    def write(self, kind, frame, value=0):
+        milliseconds = int((time.perf_counter() - self.start) * 1000) & 0xFFFFFFFF
+        self.file.write(RECORD.pack(kind, frame, milliseconds, value))
+        self.records += 1
+
+    def record(self, frame, events):
+        """Records the key presses and quit events among the PyGame events
+        'events' handled in frame 'frame'."""
+        for event in events:
+            if event.type == pygame.KEYDOWN:
+                self.write(KEY_DOWN, frame, event.key)
+            elif event.type == pygame.QUIT:
+                self.write(QUIT, frame)
+
+    def checkpoint(self, frame, state_hash):
+        """Records the hash 'state_hash' of the state of the simulation in
+        frame 'frame'."""
+        self.write(CHECKPOINT, frame, state_hash)
+        self.file.flush()
+
+    def close(self, frame):
+        """Records that the session ended before frame 'frame' and closes
+        the file."""
+        self.write(END, frame)
+        self.file.close()
+
+def load_recording(filename):
+    """Returns the header and the list of (kind, frame, milliseconds,
+    value) records of the recording 'filename'. An incomplete last record is
+    left out."""
+    with open(filename, "rb") as file:
+        data = file.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("{0} is no recording.".format(filename))
+    start = len(MAGIC) + 4
+    header_length, = struct.unpack(">I", data[len(MAGIC):start])
+    header = json.loads(data[start:start + header_length].decode("utf-8"))
+    if header["version"] != VERSION:
+        raise ValueError("{0} has version {1} instead of {2}.".format(
+            filename, header["version"], VERSION))
+    body = data[start + header_length:]
+    count = len(body) // RECORD.size
+    return header, list(RECORD.iter_unpack(body[:count * RECORD.size]))
+
+class Replayer():
+    """Plays the recording 'filename' back: 'events' returns the events
+    of each frame and 'checkpoint' compares the state of the simulation to
+    the recorded one."""
+    def __init__(self, filename):
+        self.header, records = load_recording(filename)
+        self.checkpoint_interval = self.header["checkpoint_interval"]
+        self.inputs = {}
+        self.checkpoints = []
+        self.end = None
+        for kind, frame, milliseconds, value in records:
+            if kind == KEY_DOWN:
+                self.inputs.setdefault(frame, []).append(
+                    pygame.event.Event(pygame.KEYDOWN, key=value))
+            elif kind == QUIT:
+                self.inputs.setdefault(frame, []).append(pygame.event.Event(pygame.QUIT))
+            elif kind == CHECKPOINT:
+                self.checkpoints.append((frame, value))
+            elif kind == END:
+                self.end = frame
+        if self.end is None:
+            # Cut off: Play until the last record
+            self.end = max([frame + 1 for kind, frame, milliseconds, value in records] or [0])
+        self.checked = 0
+        self.mismatches = []
+
+    def events(self, frame):
+        """Returns the list of PyGame events to handle in frame 'frame'."""
+        return self.inputs.get(frame, [])
+
+    def record(self, frame, events):
+        """Events are not recorded again while replaying."""
+
+    def checkpoint(self, frame, state_hash):
+        """Compares the hash 'state_hash' of the state of the simulation in
+        frame 'frame' to the next recorded checkpoint."""
+        if self.checked >= len(self.checkpoints):
+            return
+        expected = self.checkpoints[self.checked]
+        self.checked += 1
+        if expected != (frame, state_hash):
+            self.mismatches.append({"checkpoint":self.checked - 1,
+                                    "expected_frame":expected[0], "frame":frame,
+                                    "expected_hash":expected[1], "hash":state_hash})
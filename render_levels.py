@@ -0,0 +1,231 @@
+# render_levels.py: Renders every level with every tile set to PNG
+#
+# For reviewing tile sets and catching rendering regressions without playing
+# through ask_for_file: Each level in levels/ is rendered by Level.render with
+# each tile set in tile_sets/maps and saved as PNG, spread over a pool of
+# processes. The inputs of every image (the level, the tile set files, the
+# rendering code and the seed of the tile variations) are hashed and stored
+# in a manifest next to the images, so images whose inputs did not change
+# since the last run are not rendered again. With --compare, the images are
+# compared pixel by pixel to those of an earlier run, the differences are
+# saved as images and listed in a report. With --scale, the zoomed out
+# backgrounds of the levels (see main02.LevelPyramid) are rendered instead,
+# e.g. to preview large levels.
+#
+#     python render_levels.py --output renders/old
+#     ... change a tile set or the rendering code ...
+#     python render_levels.py --output renders/new --compare renders/old
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import concurrent.futures
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+import atlas
+import main02
+
+MANIFEST = "manifest.json"
+REPORT = "report.json"
+# Code the rendered images depend on besides the level and the tile set
+SOURCES = ["main02.py", "grid.py", "blitter.py", "atlas.py", "constants/constants.ini"]
+DIFF_COLOR = (255, 0, 255)
+
+def file_hash(filename):
+    with open(filename, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def input_hash(level_file, tile_set, seed, scale, file_hashes):
+    """Returns a hash of everything the image of 'level_file' rendered with
+    'tile_set' at 1/'scale' of its size depends on. 'file_hashes' is a
+    dictionary caching the hashes of the files."""
+    files = [level_file] + main02.tile_set_sources(tile_set) + SOURCES
+    for filename in files:
+        if filename not in file_hashes:
+            file_hashes[filename] = file_hash(filename)
+    key = ([file_hashes[filename] for filename in files], seed, scale)
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+def image_name(level_file, tile_set, scale=1):
+    name = "{0}_{1}".format(os.path.splitext(os.path.basename(level_file))[0], tile_set)
+    if scale != 1:
+        name += "_{0}".format(scale)
+    return name + ".png"
+
+def image_hash(image):
+    return hashlib.sha1(pygame.image.tobytes(image, "RGB")).hexdigest()
+
+def init_display():
+    """Sets a display mode, which is needed to convert images, once per
+    process."""
+    if pygame.display.get_surface() is None:
+        pygame.init()
+        pygame.display.set_mode((1, 1))
+
+def render(level_file, tile_set, seed, scale, filename):
+    """Renders 'level_file' with 'tile_set' and the tile variations of
+    'seed' at 1/'scale' of its size and saves it as 'filename'. Returns the
+    hash and the size of the image and the time taken. Meant to be run in a
+    worker process."""
+    start = time.perf_counter()
+    init_display()
+    random.seed(seed)
+    level = main02.Level()
+    level.load_file(level_file, tile_set)
+    if scale == 1:
+        image = level.render()
+    else:
+        image = level.render_pyramid((scale,)).images[scale]
+    pygame.image.save(image, filename)
+    return {"image":image_hash(image),
+            "size":list(image.get_size()),
+            "seconds":time.perf_counter() - start,
+           }
+
+def compare_images(old_file, new_file, diff_file):
+    """Compares the images 'old_file' and 'new_file' pixel by pixel. The new
+    image is saved darkened with the differing pixels highlighted as
+    'diff_file'. Returns a dictionary with the number of differing pixels."""
+    init_display()
+    old = pygame.image.load(old_file)
+    new = pygame.image.load(new_file)
+    if old.get_size() != new.get_size():
+        return {"status":"resized", "old_size":list(old.get_size()),
+                "size":list(new.get_size())}
+    # Equal pixels are white and differing ones black
+    equal = pygame.PixelArray(new).compare(pygame.PixelArray(old)).make_surface()
+    differing = pygame.mask.from_threshold(equal, (0, 0, 0), (1, 1, 1, 255))
+    diff = new.convert()
+    diff.fill((96, 96, 96), special_flags=pygame.BLEND_MULT)
+    diff.blit(differing.to_surface(setcolor=DIFF_COLOR, unsetcolor=None), (0, 0))
+    pygame.image.save(diff, diff_file)
+    return {"status":"changed", "pixels":differing.count(),
+            "fraction":differing.count() / (new.get_width() * new.get_height())}
+
+def bake_atlases(tile_sets):
+    """Bakes the atlases of 'tile_sets' that are missing or outdated, so
+    the workers only read them and never write the same atlas at once."""
+    for tile_set in tile_sets:
+        legend = main02.load_legend(tile_set)
+        if atlas.read_atlas(main02.atlas_file_name(tile_set), main02.tile_set_sources(tile_set),
+                            main02.legend_hash(legend)) is None:
+            init_display()
+            main02.bake_tile_set(tile_set, legend)
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def render_all(level_files, tile_sets, output, seed=0, scale=1, processes=None, force=False):
+    """Renders each of 'level_files' with each of 'tile_sets' at 1/'scale'
+    of its size into the directory 'output' unless the image there is up to
+    date. Returns the manifest of all images and the number of rendered
+    images."""
+    os.makedirs(output, exist_ok=True)
+    old_manifest = load_manifest(output)
+    manifest = {}
+    jobs = {}
+    file_hashes = {}
+    for tile_set in tile_sets:
+        for level_file in level_files:
+            name = image_name(level_file, tile_set, scale)
+            entry = {"level":level_file, "tile_set":tile_set, "scale":scale,
+                     "input":input_hash(level_file, tile_set, seed, scale, file_hashes)}
+            old = old_manifest.get(name)
+            if (not force and old is not None and old["input"] == entry["input"]
+                    and os.path.exists(os.path.join(output, name))):
+                manifest[name] = old
+            else:
+                manifest[name] = entry
+                jobs[name] = entry
+    bake_atlases(sorted(set(entry["tile_set"] for entry in jobs.values())))
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        futures = {name:executor.submit(render, entry["level"], entry["tile_set"], seed, scale,
+                                        os.path.join(output, name))
+                   for name, entry in jobs.items()}
+        for name, future in futures.items():
+            manifest[name].update(future.result())
+    with open(os.path.join(output, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    return manifest, len(jobs)
+
+def compare_runs(manifest, output, baseline, processes=None):
+    """Compares the images in 'output' described by 'manifest' to those of
+    an earlier run in the directory 'baseline'. The differences are saved in
+    the subdirectory "diff" of 'output'. Returns the report as dictionary
+    with an entry for each image that is new or changed."""
+    old_manifest = load_manifest(baseline)
+    report = {}
+    changed = []
+    for name in sorted(manifest):
+        if name not in old_manifest:
+            report[name] = {"status":"new"}
+        elif manifest[name]["image"] != old_manifest[name]["image"]:
+            changed.append(name)
+    if changed:
+        diff_directory = os.path.join(output, "diff")
+        os.makedirs(diff_directory, exist_ok=True)
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            futures = {name:executor.submit(compare_images, os.path.join(baseline, name),
+                                            os.path.join(output, name),
+                                            os.path.join(diff_directory, name))
+                       for name in changed}
+            for name, future in futures.items():
+                report[name] = future.result()
+    with open(os.path.join(output, REPORT), "w") as file:
+        json.dump(report, file, indent=1, sort_keys=True)
+    return report
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Renders every level with every tile set "
+                                     "to PNG.")
+    parser.add_argument("--levels", nargs="*", help="level files (all in levels/ by default)")
+    parser.add_argument("--tile-sets", nargs="*",
+                        help="tile set names (all in tile_sets/maps by default)")
+    parser.add_argument("--output", default="renders", help="directory of the images")
+    parser.add_argument("--compare", help="directory of an earlier run to compare to")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the tile variations")
+    parser.add_argument("--scale", type=int, choices=(1,) + main02.MINIMAP_SCALES, default=1,
+                        help="render at 1/scale of the full size")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (one per CPU by default)")
+    parser.add_argument("--force", action="store_true",
+                        help="render all images, even those that are up to date")
+    options = parser.parse_args(arguments)
+
+    level_files = options.levels or sorted(
+        os.path.join(main02.FOLDERS["LEVELS"], name)
+        for name in os.listdir(main02.FOLDERS["LEVELS"]) if name.endswith(".ini"))
+    tile_sets = options.tile_sets or sorted(
+        name[:-4] for name in os.listdir(main02.FOLDERS["MAPS"]) if name.endswith(".png"))
+
+    start = time.perf_counter()
+    manifest, rendered = render_all(level_files, tile_sets, options.output, options.seed,
+                                    options.scale, options.processes, options.force)
+    print("Rendered {0} of {1} images in {2:.2f} s.".format(
+        rendered, len(manifest), time.perf_counter() - start))
+
+    if options.compare:
+        report = compare_runs(manifest, options.output, options.compare, options.processes)
+        for name, entry in sorted(report.items()):
+            if entry["status"] == "changed":
+                print("{0}: {1} pixels changed ({2:.2%})".format(name, entry["pixels"],
+                                                                entry["fraction"]))
+            else:
+                print("{0}: {1}".format(name, entry["status"]))
+        print("{0} of {1} images differ from {2}.".format(len(report), len(manifest),
+                                                          options.compare))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,87 @@
+# replay.py: Replaying recorded sessions as fast as possible
+#
+# Plays back a session recorded by main02.py (see recording.py) without a
+# window and without waiting for the next frame, and checks the state of
+# the game at every recorded checkpoint. A replay that goes different from
+# the recording reports the first checkpoint where it did and exits with
+# status 1, so recordings of bug reports can be kept as regression and
+# performance tests:
+#
+#     python replay.py recordings/20170401-120000.rec
+#     python replay.py recordings/*.rec --output replays.json
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame
+
+import main02
+import recording
+
+def replay(filename):
+    """Replays the recording 'filename' and returns a dictionary of the
+    results. The screen has to be set before."""
+    replayer = recording.Replayer(filename)
+    header = replayer.header
+    random.seed(header["seed"])
+    with contextlib.redirect_stdout(io.StringIO()):
+        game = main02.Game(header["level"], header["player"], header["floors"],
+                           header["dungeon_seed"], header["tile_set"])
+        game.recording = replayer
+        start = time.perf_counter()
+        while game.running and game.frames < replayer.end:
+            game.frame(replayer.events(game.frames))
+        seconds = time.perf_counter() - start
+        game.executor.shutdown()
+    replayer.checkpoint(game.frames, game.simulation.state_hash())
+    return {"recording":filename,
+            "frames":game.frames,
+            "turns":game.simulation.turn,
+            "seconds":seconds,
+            "frames_per_second":game.frames / seconds if seconds else 0,
+            "turns_per_second":game.simulation.turn / seconds if seconds else 0,
+            "checkpoints":replayer.checked,
+            "mismatches":replayer.mismatches,
+           }
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Replays recorded sessions as fast as "
+                                     "possible and checks the state of the game.")
+    parser.add_argument("recordings", nargs="+", help="recorded sessions")
+    parser.add_argument("--output", help="file to write the results to as JSON")
+    options = parser.parse_args(arguments)
+
+    pygame.init()
+    pygame.display.set_mode(main02.SCREEN_SIZE)
+    results = []
+    for filename in options.recordings:
+        result = replay(filename)
+        results.append(result)
+        print("{0}: {1} frames, {2} turns in {3:.2f} s ({4:.0f} frames, {5:.0f} turns "
+              "per second), {6} checkpoints".format(
+                  filename, result["frames"], result["turns"], result["seconds"],
+                  result["frames_per_second"], result["turns_per_second"],
+                  result["checkpoints"]))
+        for mismatch in result["mismatches"][:1]:
+            print("  Differs from checkpoint {checkpoint} on: expected frame "
+                  "{expected_frame} and hash {expected_hash:016x}, got frame {frame} and "
+                  "hash {hash:016x}".format(**mismatch))
+    pygame.quit()
+
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(results, file, indent=1, sort_keys=True)
+    if any(result["mismatches"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
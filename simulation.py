@@ -0,0 +1,344 @@
+# simulation.py: The rules of the game without any graphics
+#
+# A Simulation advances the game turn by turn: Each turn, the player takes
+# an action (walking, using the stairs or waiting) and then all monsters
+# that have seen the player step towards where they saw the player last.
+# Nothing depends on PyGame or on the time, so a simulation with the same
+# seed and the same actions always ends up in the same state and can run as
+# fast as the CPU allows. The PyGame front end in main02.py drives a
+# Simulation with the keyboard and observes its events to draw it.
+#
+# Run "python simulation.py --runs 100 --turns 1000" for a batch of
+# simulations with random players, spread over all CPU cores.
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import concurrent.futures
+
+import dungeon
+import entities
+import fov
+import grid
+import pathfinding
+from config_cache import read_config
+
+constants = read_config("constants/constants.ini")
+DUNGEON_FLOORS = int(constants["dungeon"]["floors"])
+DUNGEON_SIZE = tuple([int(constants["dungeon"]["size_" + i]) for i in "xy"])
+DUNGEON_SEED = constants["dungeon"]["seed"] or None
+PATHFINDING_CACHE_SIZE = int(constants["pathfinding"]["cache_size"])
+ENTITY_BUCKET_SIZE = int(constants["entities"]["bucket_size"])
+FOV_RADIUS = int(constants["fov"]["radius"])
+FOV_CACHE_SIZE = int(constants["fov"]["cache_size"])
+MONSTERS = int(constants["simulation"]["monsters"])
+del constants
+
+# Actions are tuples of the name of the action and its arguments
+ACTIONS = ("walk", "stairs", "wait")
+STEPS = {"w":(0, -1), "a":(-1, 0), "s":(0, 1), "d":(1, 0)}
+
+class Entity():
+    """A thing of kind 'kind' (e.g. "player", "stairs" or "monster") at
+    ('x', 'y')."""
+    def __init__(self, kind, x=0, y=0, blocking=False):
+        self.kind = kind
+        self.x = x
+        self.y = y
+        self.blocking = blocking
+
+class World():
+    """The tiles and entities of a level without any graphics. Just like a
+    main02.Level, it has the attributes 'grid', 'entities', 'width',
+    'height', 'player_position' and 'stairs_position'."""
+    def __init__(self, level_map, default_tile, player_position, stairs_position):
+        self.width = len(level_map[0])
+        self.height = len(level_map)
+        self.grid = grid.Grid(self.width, self.height, (1, 1), default_tile, grid.TILE_FLAGS)
+        self.grid.load_map(level_map)
+        self.player_position = player_position
+        self.stairs_position = stairs_position
+        self.entities = entities.SpatialIndex(ENTITY_BUCKET_SIZE)
+
+def load_world(filename):
+    """Returns the World of the level file 'filename'."""
+    config = read_config(filename)
+    return World(config["level"]["map"].split("\n"),
+                 config["level"]["default_tile"],
+                 [int(config["player"][i]) for i in "xy"],
+                 [int(config["stairs"][i]) for i in "xy"])
+
+def generate_world(seed, size):
+    """Returns the World of a generated dungeon floor with seed 'seed' and
+    size 'size'."""
+    floor = dungeon.generate_floor(size[0], size[1], seed)
+    return World(floor.map, floor.default_tile, floor.player_position, floor.stairs_position)
+
+def prepare_world(world):
+    """Returns the path finder, the field of view and the fog of war of
+    'world' and its free floor tiles for the monsters. Only reads the data
+    of the world, so it can run in a worker thread while the previous floor
+    is played."""
+    pathfinder = pathfinding.PathFinder(world, PATHFINDING_CACHE_SIZE)
+    field_of_view = fov.FieldOfView(world, FOV_RADIUS, FOV_CACHE_SIZE)
+    fog = fov.FogOfWar(field_of_view)
+    fog.update(*world.player_position)
+    # Walkable tiles without the player, the stairs or another entity
+    taken = {tuple(world.player_position), tuple(world.stairs_position)}
+    free = [(x, y) for y in range(world.height) for x in range(world.width)
+            if pathfinder.is_walkable(x, y) and (x, y) not in taken
+            and not world.entities.at(x, y)]
+    return pathfinder, field_of_view, fog, free
+
+def prepare_floor(seed, size):
+    """Returns the World of a generated dungeon floor with seed 'seed' and
+    size 'size' and the result of 'prepare_world' for it."""
+    world = generate_world(seed, size)
+    return world, prepare_world(world)
+
+class Simulation():
+    """A game starting on 'world' (a World or a main02.Level), followed by
+    'floors' dungeon floors generated from 'seed', each with 'monsters'
+    monsters. 'player' is the player's entity. The next floor is loaded by
+    calling 'load_floor' with its seed and size, which returns the world and
+    the result of 'prepare_world' for it. Observers are called with the
+    simulation and the list of events after every turn."""
+    def __init__(self, world, seed=DUNGEON_SEED, floors=DUNGEON_FLOORS, monsters=MONSTERS,
+                 player=None, load_floor=prepare_floor, size=DUNGEON_SIZE):
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.floors = floors
+        self.monster_count = monsters
+        self.player = player if player is not None else Entity("player", blocking=True)
+        self.load_floor = load_floor
+        self.size = size
+        self.observers = []
+        self.floor = 0
+        self.turn = 0
+        self.running = True
+        self.caught = 0
+        self.world = None
+        self.set_world(world)
+
+    def set_world(self, world, prepared=None):
+        """Puts the player, the stairs and the monsters onto 'world'.
+        'prepared' is the result of 'prepare_world' for it, if already
+        known."""
+        if prepared is None:
+            prepared = prepare_world(world)
+        if self.world is not None and self.player in self.world.entities:
+            self.world.entities.remove(self.player)
+        self.world = world
+        index = world.entities
+        self.player.x, self.player.y = tuple(world.player_position)
+        index.add(self.player)
+        self.stairs = Entity("stairs", *world.stairs_position)
+        index.add(self.stairs)
+        self.pathfinder, self.field_of_view, self.fog, free = prepared
+
+        # Put the monsters onto random free floor tiles
+        self.random = random.Random(dungeon.floor_seed(self.seed, self.floor))
+        self.monsters = []
+        for x, y in self.random.sample(free, min(self.monster_count, len(free))):
+            monster = Entity("monster", x, y, True)
+            monster.target = None
+            # Whether the monster is next to the player
+            monster.catching = False
+            index.add(monster)
+            self.monsters.append(monster)
+
+    def update_tile(self, x, y):
+        """Takes into account that the tile at ('x', 'y') of the world was
+        changed. Returns the indices of the grid tiles whose visibility
+        changed."""
+        self.pathfinder.update_tile(x, y)
+        self.field_of_view.invalidate(x, y)
+        return self.fog.refresh()
+
+    def monster_at(self, x, y):
+        """Returns the monster at ('x', 'y') or None."""
+        for entity in self.world.entities.at(x, y):
+            if entity.kind == "monster":
+                return entity
+        return None
+
+    def can_enter(self, x, y):
+        return (self.world.grid.get_flags(x, y) & grid.WALKABLE
+                and not self.world.entities.is_blocked(x, y))
+
+    def step(self, action):
+        """Advances the simulation by one turn in which the player takes
+        'action'. Returns the list of events of this turn."""
+        events = []
+        player = self.player
+        name = action[0]
+        if name == "walk":
+            dx, dy = STEPS[action[1]]
+            x, y = player.x + dx, player.y + dy
+            monster = self.monster_at(x, y)
+            if monster is not None and self.world.grid.get_flags(x, y) & grid.WALKABLE:
+                # Push past the monster by swapping places with it
+                self.world.entities.move(monster, player.x, player.y)
+                events.append(("moved", monster, (player.x, player.y)))
+            if self.can_enter(x, y):
+                self.world.entities.move(player, x, y)
+                events.append(("moved", player, (x, y)))
+                changed = self.fog.update(x, y)
+                if changed:
+                    events.append(("seen", changed))
+        elif name == "stairs":
+            if self.stairs in self.world.entities.at(player.x, player.y):
+                self.next_floor(events)
+        elif name != "wait":
+            raise ValueError("Unknown action {0!r}.".format(action))
+        if self.running:
+            self.move_monsters(events)
+        self.turn += 1
+        for observer in self.observers:
+            observer(self, events)
+        return events
+
+    def move_monsters(self, events):
+        """Lets every monster that sees the player step towards the player
+        and every monster that lost sight of the player step towards where
+        it saw the player last. Monsters chasing the same tile share its
+        distance field. A monster catches the player when it gets next to
+        the player, which is counted once until it is left behind."""
+        player = (self.player.x, self.player.y)
+        occupied = {(monster.x, monster.y) for monster in self.monsters}
+        for monster in self.monsters:
+            position = (monster.x, monster.y)
+            if self.field_of_view.sees(position, player):
+                monster.target = player
+            elif monster.target == position:
+                monster.target = None
+            if monster.target is None:
+                continue
+            step = self.pathfinder.next_step(position, monster.target, occupied)
+            if step is not None and step != player and self.can_enter(*step):
+                occupied.discard(position)
+                occupied.add(step)
+                self.world.entities.move(monster, *step)
+                events.append(("moved", monster, step))
+            catching = abs(monster.x - player[0]) + abs(monster.y - player[1]) == 1
+            if catching and not monster.catching:
+                self.caught += 1
+                events.append(("caught", monster))
+            monster.catching = catching
+
+    def next_floor(self, events):
+        """Goes to the next floor or ends the game after the last one."""
+        if self.floor >= self.floors:
+            self.running = False
+            events.append(("finished",))
+            return
+        self.floor += 1
+        self.set_world(*self.load_floor(dungeon.floor_seed(self.seed, self.floor), self.size))
+        events.append(("floor", self.floor))
+
+    def run(self, policy, turns):
+        """Runs at most 'turns' turns, taking the actions returned by
+        'policy' (called with the simulation). Stops early when the game
+        ends. Returns the number of turns run."""
+        for turn in range(turns):
+            if not self.running:
+                return turn
+            self.step(policy(self))
+        return turns
+
+    def state_hash(self):
+        """Returns a 64 bit hash of the state of the game. Simulations with
+        the same seed and the same actions have the same state."""
+        state = (self.seed, self.floor, self.turn, self.running, self.caught,
+                 (self.player.x, self.player.y),
+                 [(monster.x, monster.y, monster.target) for monster in self.monsters])
+        digest = hashlib.sha1(repr(state).encode("utf-8"))
+        digest.update(self.world.grid.types)
+        digest.update(self.fog.explored)
+        return int.from_bytes(digest.digest()[:8], "big")
+
+    def statistics(self):
+        """Returns a dictionary of the simulation statistics."""
+        return {"seed":self.seed,
+                "turn":self.turn,
+                "floor":self.floor,
+                "running":self.running,
+                "caught":self.caught,
+                "monsters":len(self.monsters),
+               }
+
+def random_policy(simulation):
+    """Walks randomly and takes the stairs when standing on them."""
+    player = simulation.player
+    if (player.x, player.y) == (simulation.stairs.x, simulation.stairs.y):
+        return ("stairs",)
+    return ("walk", simulation.random.choice("wasd"))
+
+def stairs_policy(simulation):
+    """Walks straight to the stairs and takes them, pushing past the
+    monsters on the way."""
+    player = simulation.player
+    stairs = (simulation.stairs.x, simulation.stairs.y)
+    if (player.x, player.y) == stairs:
+        return ("stairs",)
+    step = simulation.pathfinder.next_step((player.x, player.y), stairs)
+    if step is None:
+        return ("wait",)
+    for direction, (dx, dy) in STEPS.items():
+        if (player.x + dx, player.y + dy) == step:
+            return ("walk", direction)
+
+POLICIES = {"random":random_policy, "stairs":stairs_policy}
+
+def simulate(seed, turns, monsters=MONSTERS, floors=DUNGEON_FLOORS, policy="random",
+             size=DUNGEON_SIZE):
+    """Runs a simulation of 'turns' turns on generated floors and returns
+    its statistics. Meant to be run in a worker process."""
+    world = generate_world(dungeon.floor_seed(seed, 0), size)
+    simulation = Simulation(world, seed, floors, monsters, size=size)
+    start = time.perf_counter()
+    simulation.run(POLICIES[policy], turns)
+    statistics = simulation.statistics()
+    statistics["seconds"] = time.perf_counter() - start
+    return statistics
+
+def run_batch(seeds, turns, monsters=MONSTERS, floors=DUNGEON_FLOORS, policy="random",
+              size=DUNGEON_SIZE, processes=None):
+    """Runs a simulation for each seed in 'seeds' in a pool of 'processes'
+    processes (one per CPU by default) and returns their statistics in the
+    order of 'seeds'."""
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        futures = [executor.submit(simulate, seed, turns, monsters, floors, policy, size)
+                   for seed in seeds]
+        return [future.result() for future in futures]
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Runs a batch of simulations without "
+                                     "graphics.")
+    parser.add_argument("--runs", type=int, default=os.cpu_count() or 1,
+                        help="number of simulations")
+    parser.add_argument("--turns", type=int, default=1000, help="turns per simulation")
+    parser.add_argument("--monsters", type=int, default=MONSTERS, help="monsters per floor")
+    parser.add_argument("--floors", type=int, default=DUNGEON_FLOORS)
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="random")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first simulation")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes (one per CPU by default)")
+    options = parser.parse_args(arguments)
+
+    start = time.perf_counter()
+    results = run_batch(range(options.seed, options.seed + options.runs), options.turns,
+                        options.monsters, options.floors, options.policy,
+                        processes=options.processes)
+    seconds = time.perf_counter() - start
+    for statistics in results:
+        print(json.dumps(statistics, sort_keys=True))
+    turns = sum(statistics["turn"] for statistics in results)
+    print("{0} turns in {1:.2f} s ({2:.0f} turns per second).".format(
+        turns, seconds, turns / seconds))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
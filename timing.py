@@ -0,0 +1,82 @@
+# timing.py: Running the game logic at a fixed rate and drawing in between
+#
+# The logic of the game (input, animation clock, movement) advances in
+# logic frames of a fixed length, so it runs at the same speed on every
+# machine, while frames are drawn as often as the machine manages (up to a
+# limit). The time since the last logic frame is kept, and drawing
+# interpolates between the last two logic frames with it. If drawing falls
+# behind, several logic frames are run before the next frame is drawn, i.e.
+# drawn frames are skipped but logic frames never are. Only if more than
+# 'max_frame_skip' frames would be skipped in a row, the game slows down
+# instead.
+
+import time
+import collections
+
+class FrameScheduler():
+    """Schedules logic frames at 'rate' per second. 'clock' returns the
+    time in seconds. The intervals between the last 'capacity' drawn frames
+    are kept for the statistics."""
+    def __init__(self, rate, max_frame_skip=5, capacity=1024, clock=time.perf_counter):
+        self.rate = rate
+        self.step = 1 / rate
+        self.max_frame_skip = max_frame_skip
+        self.clock = clock
+        self.start = self.last = clock()
+        self.last_drawn = None
+        self.accumulator = 0.0
+        self.intervals = collections.deque(maxlen=capacity)
+        self.logic_frames = 0
+        self.drawn = 0
+        self.skipped = 0
+        self.dropped = 0.0
+
+    def advance(self):
+        """Returns the number of logic frames to run before drawing the next
+        frame. Time beyond 'max_frame_skip' skipped frames is dropped."""
+        now = self.clock()
+        self.accumulator += now - self.last
+        self.last = now
+        steps = int(self.accumulator // self.step)
+        if steps > self.max_frame_skip + 1:
+            self.dropped += (steps - self.max_frame_skip - 1) * self.step
+            self.accumulator -= (steps - self.max_frame_skip - 1) * self.step
+            steps = self.max_frame_skip + 1
+        self.accumulator -= steps * self.step
+        self.logic_frames += steps
+        if steps > 1:
+            self.skipped += steps - 1
+        return steps
+
+    @property
+    def alpha(self):
+        """How far the time is between the last logic frame and the next,
+        from 0 to 1."""
+        return min(self.accumulator / self.step, 1.0)
+
+    def drawn_frame(self):
+        """Counts a drawn frame."""
+        now = self.clock()
+        if self.last_drawn is not None:
+            self.intervals.append(now - self.last_drawn)
+        self.last_drawn = now
+        self.drawn += 1
+
+    def statistics(self):
+        """Returns a dictionary of the frame pacing statistics: frames
+        drawn, skipped and per second, the rate of logic frames reached, the
+        time dropped because drawing was too slow and the percentiles of the
+        intervals between drawn frames in milliseconds."""
+        seconds = max(self.last - self.start, 1e-9)
+        intervals = sorted(self.intervals)
+        result = {"logic_frames":self.logic_frames,
+                  "logic_rate":self.logic_frames / seconds,
+                  "drawn":self.drawn,
+                  "skipped":self.skipped,
+                  "frames_per_second":self.drawn / seconds,
+                  "dropped_seconds":self.dropped,
+                 }
+        for p in (50, 90, 99):
+            rank = max(1, -(-len(intervals) * p // 100))
+            result["interval_p{0}".format(p)] = intervals[rank - 1] * 1000 if intervals else 0.0
+        return result